@@ -4,11 +4,88 @@ import math
 import numpy as np
 import os.path
 import csv
+import hashlib
+import threading
+import time
 import openpyxl
+from collections import OrderedDict
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog
 import cv2
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+# Coarse-to-fine template search settings
+PYRAMID_MIN_TEMPLATE_SIDE = 24  # Template is not downsampled below this size (in pixels)
+PYRAMID_THRESHOLD_SLACK = 0.05  # Coarse threshold is lowered by this value for every pyramid level
+PYRAMID_CANDIDATES_FACTOR = 4  # Coarse candidates kept per angle relative to the amount of elements to find
+PYRAMID_REFINE_RADIUS = 2  # Refinement window radius around a coarse peak (in coarse pixels)
+
+# Cache of rotated templates and masks shared by all searches
+ROTATED_TEMPLATE_BANK_MAX_BYTES = 256 * 1024 * 1024
+
+# FFT matching engine settings
+FFT_MIN_IMAGE_ENERGY = 1e-3  # Positions where the plan is almost black under the mask get zero correlation
+
+# Binarization of the plan lines
+INK_THRESHOLD = 128  # Pixels darker than this are the ink of the plan lines
+
+# Chamfer matching engine settings
+CHAMFER_MAX_DISTANCE = 20  # Distances to the plan edges are truncated, so a missing line costs the same everywhere
+
+# Non-maximum suppression of found variations
+NMS_CENTER_MARGIN = 5  # Variations with closer centers (in pixels) are always treated as one element
+NMS_OVERLAP_THRESHOLD = 0.5  # Variations with larger intersection over union are treated as one element
+
+# Rotational symmetry detection of templates
+SYMMETRY_MAX_UNMATCHED_INK = 0.03  # Template rotated by the period may miss at most this part of the template ink
+SYMMETRY_INK_TOLERANCE = 1  # Ink is matched within this distance (in pixels), so half-pixel line offsets are symmetric
+SYMMETRY_MAX_SHIFT = 2  # ROI borders are not exact, so the rotated template may be shifted by this amount of pixels
+
+# Restriction of rotation angles to the dominant orientations of the plan
+ORIENTATION_HISTOGRAM_BINS = 90  # Orientations are folded modulo 90 degrees, so every bin is 1 degree wide
+ORIENTATION_MIN_SHARE = 0.3  # Orientation is dominant if its histogram peak is at least this share of the highest one
+ORIENTATION_PEAK_WIDTH = 3  # Orientations closer than this to a histogram peak (in degrees) refine its position
+DOMINANT_ORIENTATIONS_AMOUNT = 2  # Plans usually have one or two wall directions
+
+# Coarse-then-fine angular search
+ANGLE_STEP = 5  # Step of the rotation angles when the angular refinement is disabled
+ANGLE_COARSE_STEP = 15  # Step of the coarse sweep, found candidates are refined to sub-degree angles
+ANGLE_COARSE_INK_WIDTH = 5  # Lines are thickened by this kernel for the coarse sweep, so inexact angles still match
+ANGLE_COARSE_CANDIDATES_FACTOR = 2  # Coarse candidates kept per angle relative to the amount of elements to find
+ANGLE_COARSE_MIN_SCORE = 0.1  # Coarse candidates are selected by rank, this score only skips empty positions
+ANGLE_REFINE_RADIUS = 4  # Refinement window radius around the candidate position (in pixels)
+ANGLE_REFINE_MIN_STEP = 0.5  # Angle refinement stops at this step (in degrees)
+
+# Search of templates drawn at different scales
+SCALE_SCREENING_LEVELS = 1  # Scales are screened on the plan downsampled by this amount of pyramid levels
+SCALE_SCREENING_SLACK = 0.05  # Screening threshold is lowered by this value for every pyramid level
+SCALE_MIN_PROMINENCE = 0.11  # Best peak of a found scale rises at least this much above the 99th score percentile
+
+# Search of windows and doors near the walls only
+WALL_BAND_MARGIN = 5  # Band around the walls is wider than half of the template by this amount of pixels
+
+# Ink density prefilter of template positions
+INK_DENSITY_TOLERANCE = 0.5  # Positions whose ink amount differs from the template one by a larger share are skipped
+SEARCH_AREA_STRIP_HEIGHT = 256  # Filtered search area is covered by windows of at most this height (in pixels)
+
+# Parallel template search settings
+MATCHING_CHUNKS_PER_WORKER = 2  # Rotation angles are split into this amount of chunks for every worker process
+MATCHING_MAX_WORKERS = 8  # Every worker process keeps its own pyramid and spectra of the plan, so they are limited
+
+# Disk cache of found variations
+DETECTION_CACHE_DIRECTORY = os.environ.get('PLAN_DETECTION_CACHE_DIRECTORY', os.path.join(
+    os.path.expanduser('~'), '.plan-image-processing', 'detection-cache'))
+DETECTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DETECTION_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # Entries older than this (in seconds) are removed
+DETECTION_ENGINE_VERSION = 1  # Increase when the search changes, so results of the older search are not reused
+
+# Process pool, the shared arrays and the plan attached by a worker process
+matching_executor = None
+matching_executor_workers = 0
+matching_worker_shared_arrays = {}
+matching_worker_plan = None
 
 
 def is_coordinate_inside_circle(x, y, center_x, center_y, radius):
@@ -16,7 +93,13 @@ def is_coordinate_inside_circle(x, y, center_x, center_y, radius):
     return distance <= radius
 
 
-def rotate_template_and_get_mask(template, angle):
+def rotate_template_and_get_mask(template, angle, exact_right_angles=True):
+    # Rotations by multiples of 90 degrees are exact transposes, without interpolation and padding. Scores of
+    # nearby angles are compared only between interpolated rotations, so the angle refinement disables them
+    if exact_right_angles and angle % 90 == 0:
+        rotated_template = np.ascontiguousarray(np.rot90(template, int(angle // 90) % 4))
+        return rotated_template, get_rotated_mask(cv2.bitwise_not(rotated_template), is_exact=True)
+
     # Get the dimensions of the image
     height, width = template.shape[:2]
 
@@ -46,74 +129,1282 @@ def rotate_template_and_get_mask(template, angle):
     # Apply the rotation to the image
     rotated_template = cv2.warpAffine(template, rotation_matrix, (new_width, new_height))
     rotated_mask = cv2.warpAffine(cv2.bitwise_not(template), rotation_matrix, (new_width, new_height))
+
+    return rotated_template, get_rotated_mask(rotated_mask, get_paper_ink(template))
+
+
+def get_paper_ink(template):
+    # Ink level of the paper between the lines after the dilation of the mask, it is above zero on scanned plans.
+    # Smoothed line borders are much darker than the paper, so they are not counted
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    dilated_ink = cv2.dilate(cv2.bitwise_not(template), kernel)
+    paper_ink = dilated_ink[dilated_ink < (255 - INK_THRESHOLD) // 2]
+    return int(np.median(paper_ink)) if paper_ink.size > 0 else 0
+
+
+def get_rotated_mask(rotated_ink, paper_ink=0, is_exact=False):
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    rotated_mask = cv2.dilate(rotated_mask, kernel, iterations=1)
+    rotated_mask = cv2.dilate(rotated_ink, kernel, iterations=1)
+    # Exact rotation of a template without blank pixels fills its box, it is decided before the normalization
+    # zeroes the lightest pixel
+    if is_exact and cv2.countNonZero(rotated_mask) == rotated_mask.size:
+        rotated_mask[:] = 255
+        return rotated_mask
+    # Weights start at the paper level, so the blank padding of the rotated box does not change the weight of the paper
+    rotated_mask = cv2.subtract(rotated_mask, paper_ink)
     # ret, rotated_mask = cv2.threshold(rotated_mask, 10, 255, cv2.THRESH_BINARY)
     cv2.normalize(rotated_mask, rotated_mask, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
+    return rotated_mask
 
-    return rotated_template, rotated_mask
 
+def get_matching_mask(rotated_mask):
+    # Mask covering the whole template box does not change the correlation, so the faster unmasked matching is used
+    if cv2.countNonZero(rotated_mask) == rotated_mask.size:
+        return None
+    return rotated_mask
+
+
+class RotatedTemplateBank:
+    # Rotated templates and masks of the last searches, least recently used ones are evicted first
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+
+    def get_rotated_template_and_mask(self, template, angle, exact_right_angles=True):
+        key = (get_template_hash(template), float(angle), exact_right_angles and angle % 90 == 0)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        rotated_template, rotated_mask = rotate_template_and_get_mask(template, angle, exact_right_angles)
+        rotated_template.flags.writeable = False
+        rotated_mask.flags.writeable = False
+        entry_bytes = rotated_template.nbytes + rotated_mask.nbytes
+        if entry_bytes <= self.max_bytes:
+            self.entries[key] = (rotated_template, rotated_mask)
+            self.used_bytes += entry_bytes
+            while self.used_bytes > self.max_bytes:
+                _, (evicted_template, evicted_mask) = self.entries.popitem(last=False)
+                self.used_bytes -= evicted_template.nbytes + evicted_mask.nbytes
+        return rotated_template, rotated_mask
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+
+def get_template_hash(template):
+    template = np.ascontiguousarray(template)
+    template_hash = hashlib.blake2b(template.tobytes(), digest_size=16)
+    template_hash.update(str((template.shape, template.dtype.str)).encode())
+    return template_hash.hexdigest()
+
+
+rotated_template_bank = RotatedTemplateBank(ROTATED_TEMPLATE_BANK_MAX_BYTES)
+
+
+def thicken_ink(image, ink_width):
+    # Dark lines of the plan are widened by erosion of the white background
+    return cv2.erode(image, cv2.getStructuringElement(cv2.MORPH_RECT, (ink_width, ink_width)))
+
+
+def get_coarse_ink_width(template, engine='opencv'):
+    # Distance transform already tolerates inexact angles, thickened lines would only move the chamfer edges
+    if engine == 'chamfer':
+        return 0
+    # Thin templates would lose their white gaps, so the kernel is limited by the template size
+    ink_width = min(ANGLE_COARSE_INK_WIDTH, min(template.shape[:2]) // 5)
+    if ink_width % 2 == 0:
+        ink_width -= 1
+    return ink_width if ink_width >= 3 else 0
+
+
+def get_ink(image):
+    return (image < INK_THRESHOLD).astype(np.uint8)
+
+
+def get_ink_edges(image):
+    # Binary line art is reduced to the borders of its ink, so line weight does not change the edge positions much
+    ink = get_ink(image)
+    return ink - cv2.erode(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)))
+
+
+def get_chamfer_distance_transform(image):
+    # Distance of every pixel to the nearest ink edge of the plan
+    distance_transform = cv2.distanceTransform(np.where(get_ink_edges(image) > 0, 0, 255).astype(np.uint8),
+                                               cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return np.minimum(distance_transform, CHAMFER_MAX_DISTANCE).astype(np.float32)
+
+
+def match_chamfer(distance_transform, rotated_template, rotated_mask):
+    # Mean distance from the template edge points to the plan edges, mapped to 1 for the exact match and 0 for none
+    edges = get_ink_edges(np.where(rotated_mask > 0, rotated_template, 255)).astype(np.float32)
+    edge_points_amount = float(edges.sum())
+    result_shape = (distance_transform.shape[0] - edges.shape[0] + 1, distance_transform.shape[1] - edges.shape[1] + 1)
+    if edge_points_amount == 0:
+        return np.zeros(result_shape, dtype=np.float32)
+    # Correlation with the edge map sums the distances under all edge points of every position at once
+    distances_sum = cv2.matchTemplate(distance_transform, edges, cv2.TM_CCORR)
+    return 1 - distances_sum / (edge_points_amount * CHAMFER_MAX_DISTANCE)
+
+
+def get_rotated_patch(image, center, size, angle):
+    # Same patch as getRectSubPix of the whole image rotated around the center, but only the pixels under the patch
+    # are sampled, so the cost does not depend on the plan size. Borders are the same too: plan corners rotated
+    # into the image are black, and the patch beyond the rotated image repeats its border pixels
+    width, height = size
+    image_height, image_width = image.shape[:2]
+    inverse_matrix = cv2.invertAffineTransform(cv2.getRotationMatrix2D(center, angle, 1.0))
+    rotated_x = np.clip(np.arange(width) + center[0] - (width - 1) / 2, 0, image_width - 1)
+    rotated_y = np.clip(np.arange(height) + center[1] - (height - 1) / 2, 0, image_height - 1)
+    rotated_x, rotated_y = np.meshgrid(rotated_x, rotated_y)
+    source_x = inverse_matrix[0, 0] * rotated_x + inverse_matrix[0, 1] * rotated_y + inverse_matrix[0, 2]
+    source_y = inverse_matrix[1, 0] * rotated_x + inverse_matrix[1, 1] * rotated_y + inverse_matrix[1, 2]
+
+    # Bounding region of the patch in the plan, the coordinates are moved to its origin
+    x_start = max(int(np.floor(source_x.min())) - 1, 0)
+    y_start = max(int(np.floor(source_y.min())) - 1, 0)
+    x_end = min(int(np.ceil(source_x.max())) + 2, image_width)
+    y_end = min(int(np.ceil(source_y.max())) + 2, image_height)
+    if x_start >= x_end or y_start >= y_end:
+        return np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+    return cv2.remap(image[y_start:y_end, x_start:x_end], (source_x - x_start).astype(np.float32),
+                     (source_y - y_start).astype(np.float32), cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                     borderValue=0)
+
+
+def build_image_pyramid(image, levels):
+    # Level 0 is the image itself, every next level is twice smaller
+    pyramid = [image]
+    for level in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+class PlanSpectrum:
+    # Spectra of the plan and of the squared plan, calculated once and reused for every template rotation
+    def __init__(self, image):
+        self.image_height, self.image_width = image.shape[:2]
+        self.dft_size = (cv2.getOptimalDFTSize(self.image_height), cv2.getOptimalDFTSize(self.image_width))
+        image = image.astype(np.float32) / 255
+        self.image_spectrum = self.get_spectrum(image)
+        self.squared_image_spectrum = self.get_spectrum(image * image)
+
+    def get_spectrum(self, array):
+        padded_array = np.zeros(self.dft_size, dtype=np.float32)
+        padded_array[:array.shape[0], :array.shape[1]] = array
+        return cv2.dft(padded_array)
+
+    def correlate(self, spectrum, kernel):
+        # Spectrum is padded at least to the plan size, so valid positions are not affected by the cyclic wrap
+        correlation = cv2.idft(cv2.mulSpectrums(spectrum, self.get_spectrum(kernel), 0, conjB=True),
+                               flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        return correlation[:self.image_height - kernel.shape[0] + 1, :self.image_width - kernel.shape[1] + 1]
+
+    def match_template(self, rotated_template, rotated_mask):
+        # Same value as cv2.matchTemplate with TM_CCORR_NORMED, 8-bit mask is used there as a binary one
+        mask = (rotated_mask > 0).astype(np.float32)
+        masked_template = rotated_template.astype(np.float32) / 255 * mask
+        numerator = self.correlate(self.image_spectrum, masked_template)
+        image_energy = self.correlate(self.squared_image_spectrum, mask)
+        denominator = np.sqrt(np.maximum(image_energy, 0) * float(np.sum(masked_template * masked_template)))
+        result = np.zeros_like(numerator)
+        np.divide(numerator, denominator, out=result, where=image_energy > FFT_MIN_IMAGE_ENERGY)
+        return result
+
+
+class PreparedPlan:
+    # Grayscale plan with its pyramid levels and spectra, they are built once and shared by all searches on it
+    def __init__(self, image):
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        self.pyramid = [image]
+        self.spectra = {}
+        self.distance_transforms = {}
+        self.ink_integral = None
+        self.center_mask_key = None
+        self.center_mask = None
+        self.thickened_plans = {}
+        self.shared_image = None
+        self.shared_center_mask_key = None
+        self.shared_center_mask = None
+        self.image_hash = None
+
+    @property
+    def image(self):
+        return self.pyramid[0]
+
+    def get_level(self, level):
+        while len(self.pyramid) <= level:
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+        return self.pyramid[level]
+
+    def get_spectrum(self, level):
+        if level not in self.spectra:
+            self.spectra[level] = PlanSpectrum(self.get_level(level))
+        return self.spectra[level]
+
+    def get_distance_transform(self, level=0):
+        if level not in self.distance_transforms:
+            self.distance_transforms[level] = get_chamfer_distance_transform(self.get_level(level))
+        return self.distance_transforms[level]
+
+    def get_ink_integral(self):
+        if self.ink_integral is None:
+            self.ink_integral = cv2.integral(get_ink(self.image))
+        return self.ink_integral
+
+    def get_ink_density_center_mask(self, template):
+        # Only the mask of the last template is kept, all angles of one template scale use it
+        key = get_template_hash(template)
+        if self.center_mask_key != key:
+            self.center_mask = get_ink_density_center_mask(self, template)
+            self.center_mask_key = key
+        return self.center_mask
+
+    def get_thickened_plan(self, ink_width):
+        if ink_width not in self.thickened_plans:
+            self.thickened_plans[ink_width] = PreparedPlan(thicken_ink(self.image, ink_width))
+        return self.thickened_plans[ink_width]
+
+    def get_hash(self):
+        if self.image_hash is None:
+            self.image_hash = get_template_hash(self.image)
+        return self.image_hash
+
+    def get_shared_image(self):
+        # Plan image is placed into the shared memory once for all parallel searches on it
+        if self.shared_image is None:
+            self.shared_image = shared_memory.SharedMemory(create=True, size=self.image.nbytes)
+            shared_array = np.ndarray(self.image.shape, dtype=self.image.dtype, buffer=self.shared_image.buf)
+            shared_array[:] = self.image
+            del shared_array
+        return self.shared_image
+
+    def get_shared_center_mask(self, template):
+        # Prefilter centers are found once for all parallel searches instead of in every worker process
+        key = get_template_hash(template)
+        if self.shared_center_mask_key != key:
+            self.release_shared_center_mask()
+            center_mask = self.get_ink_density_center_mask(template)
+            self.shared_center_mask = shared_memory.SharedMemory(create=True, size=center_mask.nbytes)
+            shared_array = np.ndarray(center_mask.shape, dtype=center_mask.dtype, buffer=self.shared_center_mask.buf)
+            shared_array[:] = center_mask
+            del shared_array
+            self.shared_center_mask_key = key
+        return self.shared_center_mask
+
+    def release_shared_center_mask(self):
+        if self.shared_center_mask is not None:
+            self.shared_center_mask.close()
+            self.shared_center_mask.unlink()
+            self.shared_center_mask = None
+            self.shared_center_mask_key = None
+
+    def release(self):
+        if self.shared_image is not None:
+            self.shared_image.close()
+            self.shared_image.unlink()
+            self.shared_image = None
+        self.release_shared_center_mask()
+        for thickened_plan in self.thickened_plans.values():
+            thickened_plan.release()
+
+    def match_template(self, rotated_template, rotated_mask, level=0, engine='opencv'):
+        if engine == 'fft':
+            return self.get_spectrum(level).match_template(rotated_template, rotated_mask)
+        if engine == 'chamfer':
+            return match_chamfer(self.get_distance_transform(level), rotated_template, rotated_mask)
+        return cv2.matchTemplate(self.get_level(level), rotated_template, cv2.TM_CCORR_NORMED,
+                                 mask=get_matching_mask(rotated_mask))
+
+
+def match_template_window(plan, rotated_template, rotated_mask, x_start, y_start, x_end, y_end, engine='opencv'):
+    # Matching restricted to a window of the full resolution plan
+    if engine == 'chamfer':
+        return match_chamfer(plan.get_distance_transform()[y_start:y_end, x_start:x_end], rotated_template,
+                             rotated_mask)
+    return cv2.matchTemplate(plan.image[y_start:y_end, x_start:x_end], rotated_template, cv2.TM_CCORR_NORMED,
+                             mask=get_matching_mask(rotated_mask))
+
+
+def compare_matching_engines(image, template, rotation_angles=(0, 45, 90)):
+    # Largest difference between the FFT engine and cv2.matchTemplate, used to check the FFT engine on real plans
+    plan = PreparedPlan(image)
+    if len(template.shape) == 3:
+        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+    max_difference = 0
+    for angle in rotation_angles:
+        rotated_template, rotated_mask = rotate_template_and_get_mask(template, angle)
+        opencv_result = plan.match_template(rotated_template, rotated_mask)
+        fft_result = plan.match_template(rotated_template, rotated_mask, engine='fft')
+        is_defined = np.isfinite(opencv_result)
+        max_difference = max(max_difference, float(np.abs(opencv_result - fft_result)[is_defined].max()))
+    return max_difference
 
-def find_template_variations(image, template, furniture_name, elements_amount, threshold=0.96):
 
-    # Preprocess image and template
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # ret, image = cv2.threshold(image_gray, 125, 255, cv2.THRESH_BINARY)
+def get_rotational_symmetry_period(template):
+    # Smallest angle (90, 180 or 360 degrees) by which the template can be rotated without changes. Only the ink is
+    # compared, so small asymmetric details (a pillow of a bed, an off-center mullion) are not hidden by the paper
+    if len(template.shape) == 3:
+        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+    # Paper of scanned plans is not blank, its ink would hide the asymmetric details
+    ink = cv2.subtract(cv2.bitwise_not(template), get_paper_ink(template))
+    ink_amount = int(ink.sum())
+    if ink_amount == 0:
+        return 360
+    height, width = ink.shape
+    kernel_size = 2 * SYMMETRY_INK_TOLERANCE + 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    for period, rotations in ((90, 1), (180, 2)):
+        rotated_ink = cv2.dilate(np.ascontiguousarray(np.rot90(ink, rotations)), kernel)
+        rotated_height, rotated_width = rotated_ink.shape
+        if rotated_height > height + 2 * SYMMETRY_MAX_SHIFT or rotated_width > width + 2 * SYMMETRY_MAX_SHIFT:
+            continue
+        # Rotated ink is centered on the template and shifted, the template ink outside of it is unmatched
+        padded_ink = np.zeros((height + 2 * SYMMETRY_MAX_SHIFT, width + 2 * SYMMETRY_MAX_SHIFT), np.uint8)
+        top, left = (padded_ink.shape[0] - rotated_height) // 2, (padded_ink.shape[1] - rotated_width) // 2
+        padded_ink[top:top + rotated_height, left:left + rotated_width] = rotated_ink
+        shifts = range(2 * SYMMETRY_MAX_SHIFT + 1)
+        unmatched_ink_amount = min(int(cv2.subtract(ink, padded_ink[y:y + height, x:x + width]).sum())
+                                   for y in shifts for x in shifts)
+        if unmatched_ink_amount <= SYMMETRY_MAX_UNMATCHED_INK * ink_amount:
+            return period
+    return 360
+
+
+def get_orientations_histogram(orientations, weights):
+    # Orientations in degrees are folded modulo 90, circularly smoothed histogram is returned
+    bins = np.floor(np.mod(orientations, 90) / 90 * ORIENTATION_HISTOGRAM_BINS).astype(np.int64)
+    bins = np.clip(bins, 0, ORIENTATION_HISTOGRAM_BINS - 1)
+    histogram = np.bincount(bins, weights=weights, minlength=ORIENTATION_HISTOGRAM_BINS).astype(np.float64)
+    return (np.roll(histogram, 1) + 2 * histogram + np.roll(histogram, -1)) / 4
+
+
+def get_dominant_orientations(image=None, walls=None):
+    # Dominant directions of the plan in rotation angles modulo 90 degrees, walls are used when they are known,
+    # otherwise orientations of the image gradient
+    if walls:
+        points = np.array(walls, dtype=np.float64)
+        deltas = points[:, 1] - points[:, 0]
+        # Image y axis points down, while positive rotation angles are counterclockwise
+        orientations = -np.degrees(np.arctan2(deltas[:, 1], deltas[:, 0]))
+        weights = np.hypot(deltas[:, 0], deltas[:, 1])
+    else:
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gradient_x = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=cv2.FILTER_SCHARR)
+        gradient_y = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=cv2.FILTER_SCHARR)
+        magnitude, orientations = cv2.cartToPolar(gradient_x, gradient_y, angleInDegrees=True)
+        is_edge = magnitude > magnitude.max() / 4
+        orientations = -orientations[is_edge].astype(np.float64)
+        weights = magnitude[is_edge].astype(np.float64)
+    if len(weights) == 0 or weights.sum() == 0:
+        return None
+
+    histogram = get_orientations_histogram(orientations, weights)
+    is_peak = (histogram >= np.roll(histogram, 1)) & (histogram > np.roll(histogram, -1)) \
+              & (histogram >= histogram.max() * ORIENTATION_MIN_SHARE)
+    peaks = np.flatnonzero(is_peak)
+    peaks = peaks[np.argsort(-histogram[peaks], kind='stable')][:DOMINANT_ORIENTATIONS_AMOUNT]
+
+    # Peak position is refined by the circular mean (with 90 degree period) of the orientations around it
+    dominant_orientations = []
+    for peak in sorted(peaks):
+        peak_orientation = (peak + 0.5) * 90 / ORIENTATION_HISTOGRAM_BINS
+        deviations = np.mod(orientations - peak_orientation + 45, 90) - 45
+        is_near = np.abs(deviations) <= ORIENTATION_PEAK_WIDTH
+        near_angles = np.radians(deviations[is_near] * 4)
+        mean_deviation = np.degrees(np.arctan2(np.sum(weights[is_near] * np.sin(near_angles)),
+                                               np.sum(weights[is_near] * np.cos(near_angles)))) / 4
+        dominant_orientations.append(float(np.mod(peak_orientation + mean_deviation, 90)))
+    return dominant_orientations
+
+
+def restrict_rotation_angles(rotation_angles, orientations, tolerance):
+    # Keep only angles which are close to a dominant orientation or to its 90 degree multiples
+    differences = np.mod(rotation_angles[:, None] - np.array(orientations)[None, :], 90)
+    differences = np.minimum(differences, 90 - differences)
+    return rotation_angles[np.any(differences <= tolerance, axis=1)]
+
+
+class SearchArea:
+    # Positions of the plan where template centers are searched. Mask is built lazily from the shapes, so the area
+    # is cheap to send to worker processes
+    def __init__(self, image_shape, walls=None, band_width=0, density_template=None, excluded_rectangles=None):
+        self.image_shape = tuple(image_shape[:2])
+        self.walls = walls
+        self.band_width = band_width
+        # Rotated rectangles ((x, y), (width, height), angle) of already confirmed elements
+        self.excluded_rectangles = excluded_rectangles
+        # Template of the ink density prefilter, its centers are found on the plan of the process using the area
+        self.density_template = density_template
+        self.center_mask = None
+        self.masks = {}
+
+    def __getstate__(self):
+        # Plan sized masks are not sent, worker processes attach the shared center mask and build the rest again
+        state = self.__dict__.copy()
+        state['center_mask'] = None
+        state['masks'] = {}
+        return state
+
+    def attach_plan(self, plan):
+        if self.density_template is not None and self.center_mask is None:
+            self.center_mask = plan.get_ink_density_center_mask(self.density_template)
+
+    def attach_center_mask(self, center_mask):
+        self.center_mask = center_mask
+
+    def get_mask(self, dilation=0):
+        if dilation not in self.masks:
+            if dilation > 0:
+                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * dilation + 1, 2 * dilation + 1))
+                self.masks[dilation] = cv2.dilate(self.get_mask(), kernel)
+            else:
+                if self.walls:
+                    mask = np.zeros(self.image_shape, dtype=np.uint8)
+                    for start_point, end_point in self.walls:
+                        cv2.line(mask, tuple(int(round(value)) for value in start_point),
+                                 tuple(int(round(value)) for value in end_point), 255, 2 * self.band_width + 1)
+                else:
+                    mask = np.full(self.image_shape, 255, dtype=np.uint8)
+                # Centers inside confirmed elements would find them again
+                for rectangle in self.excluded_rectangles or []:
+                    cv2.fillPoly(mask, [np.intp(cv2.boxPoints(rectangle))], 0)
+                if self.density_template is not None:
+                    mask[~self.center_mask] = 0
+                self.masks[dilation] = mask
+        return self.masks[dilation]
+
+    def get_regions(self):
+        # Rectangles (x_start, y_start, x_end, y_end) of template centers covering the mask, one for every wall
+        image_height, image_width = self.image_shape
+        if not self.walls:
+            regions = [(0, 0, image_width, image_height)]
+        else:
+            regions = []
+            for start_point, end_point in self.walls:
+                x_start = max(int(min(start_point[0], end_point[0])) - self.band_width, 0)
+                y_start = max(int(min(start_point[1], end_point[1])) - self.band_width, 0)
+                x_end = min(int(max(start_point[0], end_point[0])) + self.band_width + 2, image_width)
+                y_end = min(int(max(start_point[1], end_point[1])) + self.band_width + 2, image_height)
+                if x_start < x_end and y_start < y_end:
+                    regions.append((x_start, y_start, x_end, y_end))
+        if self.density_template is None:
+            return regions
+
+        # Regions are cut into strips and every strip is shrunk to the centers left by the prefilter
+        mask = self.get_mask()
+        shrunk_regions = []
+        for x_start, y_start, x_end, y_end in regions:
+            for strip_start in range(y_start, y_end, SEARCH_AREA_STRIP_HEIGHT):
+                strip = mask[strip_start:min(strip_start + SEARCH_AREA_STRIP_HEIGHT, y_end), x_start:x_end] > 0
+                rows = np.flatnonzero(strip.any(axis=1))
+                if len(rows) > 0:
+                    columns = np.flatnonzero(strip.any(axis=0))
+                    shrunk_regions.append((x_start + int(columns[0]), strip_start + int(rows[0]),
+                                           x_start + int(columns[-1]) + 1, strip_start + int(rows[-1]) + 1))
+        return shrunk_regions
+
+    def get_positions_amount(self):
+        return int(np.count_nonzero(self.get_mask()))
+
+    def get_result_mask(self, rotated_template_shape, result_shape, offset=(0, 0), scale=1, dilation=0):
+        # Top left positions of the rotated template in the result map whose template center is inside the area
+        mask = self.get_mask(dilation)
+        y_start = offset[1] * scale + rotated_template_shape[0] // 2
+        x_start = offset[0] * scale + rotated_template_shape[1] // 2
+        sampled_mask = mask[y_start::scale, x_start::scale][:result_shape[0], :result_shape[1]]
+        result_mask = np.zeros(result_shape, dtype=bool)
+        result_mask[:sampled_mask.shape[0], :sampled_mask.shape[1]] = sampled_mask > 0
+        return result_mask
+
+
+def get_wall_band_search_area(image_shape, walls, template_shape, excluded_rectangles=None):
+    # Windows and doors lie on the walls, so their centers are not farther from a wall than half of the template
+    band_width = max(template_shape[:2]) // 2 + WALL_BAND_MARGIN
+    return SearchArea(image_shape, walls, band_width, excluded_rectangles=excluded_rectangles)
+
+
+def get_square_ink_amounts(ink_integral, side):
+    # Ink amount in the square of the given side around every pixel of the plan, squares are clipped by its borders
+    image_height, image_width = ink_integral.shape[0] - 1, ink_integral.shape[1] - 1
+    y_start = np.clip(np.arange(image_height) - side // 2, 0, image_height)
+    x_start = np.clip(np.arange(image_width) - side // 2, 0, image_width)
+    y_end = np.clip(y_start + side, 0, image_height)
+    x_end = np.clip(x_start + side, 0, image_width)
+    return (ink_integral[np.ix_(y_end, x_end)] - ink_integral[np.ix_(y_start, x_end)]
+            - ink_integral[np.ix_(y_end, x_start)] + ink_integral[np.ix_(y_start, x_start)])
+
+
+def get_ink_density_center_mask(plan, template, tolerance=INK_DENSITY_TOLERANCE):
+    # Template centers whose surroundings have about as much ink as the template, the bounds hold for every rotation
+    template_height, template_width = template.shape[:2]
+    ink = get_ink(template)
+    ink_integral = plan.get_ink_integral()
+
+    # Every rotation of the template fits into the square around its circumscribed circle, so blank paper there
+    # can not contain the template
+    outer_side = int(np.ceil(np.hypot(template_height, template_width))) + 2
+    center_mask = get_square_ink_amounts(ink_integral, outer_side) >= int(ink.sum()) * (1 - tolerance)
+
+    # Square inside the inscribed circle is covered by every rotation of the template, so at an exact placement it
+    # holds no more ink than the template has around its center (a pixel farther for the rounding of the center and
+    # the interpolation). Walls may cross the element, so only the square much denser than that is skipped
+    radius = min(template_height, template_width) / 2
+    inner_side = max(int(radius * np.sqrt(2)), 1)
+    y, x = np.ogrid[:template_height, :template_width]
+    is_near_center = (y - (template_height - 1) / 2) ** 2 + (x - (template_width - 1) / 2) ** 2 <= (radius + 1.5) ** 2
+    center_ink_amount = min(int(ink[is_near_center].sum()), inner_side ** 2)
+    max_inner_ink_amount = center_ink_amount + tolerance * (inner_side ** 2 - center_ink_amount)
+    center_mask &= get_square_ink_amounts(ink_integral, inner_side) <= max_inner_ink_amount
+    return center_mask
+
+
+def get_pruned_exact_placements(template, rotation_angles=range(0, 360, 15)):
+    # Angles at which the template placed exactly on blank paper is skipped by the prefilter, used to check
+    # the prefilter bounds on real symbols. The list must be empty
+    if len(template.shape) == 3:
+        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+    pruned_angles = []
+    for angle in rotation_angles:
+        rotated_template, _ = rotate_template_and_get_mask(template, angle)
+        rotated_template_height, rotated_template_width = rotated_template.shape
+        margin = max(rotated_template.shape)
+        image = np.full((rotated_template_height + 2 * margin, rotated_template_width + 2 * margin), 255, np.uint8)
+        image[margin:margin + rotated_template_height, margin:margin + rotated_template_width] = rotated_template
+        center_mask = get_ink_density_center_mask(PreparedPlan(image), template)
+        if not center_mask[margin + rotated_template_height // 2, margin + rotated_template_width // 2]:
+            pruned_angles.append(angle)
+    return pruned_angles
+
+
+def get_ink_density_search_area(plan, template, search_area=None):
+    if search_area is None:
+        density_search_area = SearchArea(plan.image.shape, density_template=template)
+    else:
+        density_search_area = SearchArea(search_area.image_shape, search_area.walls, search_area.band_width, template,
+                                         search_area.excluded_rectangles)
+    density_search_area.attach_plan(plan)
+    return density_search_area
+
+
+def find_search_area_peaks(plan, rotated_template, rotated_mask, search_area, elements_amount, threshold, engine):
+    # Correlation is calculated only in the rectangles covering the search area, the rest of the plan is skipped
+    rotated_template_height, rotated_template_width = rotated_template.shape
+    image_height, image_width = plan.image.shape
+    neighbourhood = max(min(rotated_template.shape) // 2, 3)
+    if engine == 'fft':
+        # Spectrum of the whole plan is already calculated, so the full map is cheaper than the windows
+        windows = [(0, 0, image_width, image_height)]
+    else:
+        windows = []
+        for x_start, y_start, x_end, y_end in search_area.get_regions():
+            windows.append((max(x_start - rotated_template_width // 2, 0),
+                            max(y_start - rotated_template_height // 2, 0),
+                            min(x_end - rotated_template_width // 2 + rotated_template_width - 1, image_width),
+                            min(y_end - rotated_template_height // 2 + rotated_template_height - 1, image_height)))
+
+    points = {}
+    for x_start, y_start, x_end, y_end in windows:
+        if x_end - x_start < rotated_template_width or y_end - y_start < rotated_template_height:
+            continue
+        if engine == 'fft':
+            result = plan.match_template(rotated_template, rotated_mask, engine=engine)
+        else:
+            result = match_template_window(plan, rotated_template, rotated_mask, x_start, y_start, x_end, y_end,
+                                           engine)
+        result = np.nan_to_num(result, nan=0, posinf=0, neginf=0)
+        result[~search_area.get_result_mask(rotated_template.shape, result.shape, (x_start, y_start))] = 0
+        loc = find_top_peaks(result, threshold, elements_amount, neighbourhood)
+        for pt_y, pt_x in zip(*loc):
+            points[(int(x_start + pt_x), int(y_start + pt_y))] = float(result[pt_y, pt_x])
+
+    # Windows of neighbouring walls overlap, so the best peaks are chosen from all of them together
+    points = sorted(points.items(), key=lambda item: -item[1])[:elements_amount]
+    points.sort(key=lambda item: (item[0][1], item[0][0]))
+    loc = (np.array([point[1] for point, score in points], dtype=np.intp),
+           np.array([point[0] for point, score in points], dtype=np.intp))
+    return loc, [score for point, score in points]
+
+
+def get_pyramid_levels(template, pyramid_levels):
+    # Do not downsample the template below the minimal size, otherwise coarse matching finds nothing
+    levels = 0
+    min_side = min(template.shape[:2])
+    while levels < pyramid_levels and min_side / 2 ** (levels + 1) >= PYRAMID_MIN_TEMPLATE_SIDE:
+        levels += 1
+    return levels
+
+
+def find_top_peaks(result, threshold, peaks_amount, neighbourhood):
+    # Single pass over the correlation map: local maxima above the threshold, at most peaks_amount best of them
+    result = np.nan_to_num(result, nan=0, posinf=0, neginf=0)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (neighbourhood, neighbourhood))
+    local_maxima = cv2.dilate(result, kernel)
+    loc = np.where((result >= threshold) & (result >= local_maxima))
+    if len(loc[0]) > peaks_amount:
+        best = np.argpartition(result[loc], -peaks_amount)[-peaks_amount:]
+        best.sort()
+        loc = (loc[0][best], loc[1][best])
+    return loc
+
+
+def refine_pyramid_peak(plan, rotated_template, rotated_mask, pt, radius, threshold, engine='opencv'):
+    # Match the full resolution template only in a small window around the coarse peak
+    rotated_template_height, rotated_template_width = rotated_template.shape
+    image_height, image_width = plan.image.shape
+    x_start = max(pt[0] - radius, 0)
+    y_start = max(pt[1] - radius, 0)
+    x_end = min(pt[0] + radius + rotated_template_width, image_width)
+    y_end = min(pt[1] + radius + rotated_template_height, image_height)
+    if x_end - x_start < rotated_template_width or y_end - y_start < rotated_template_height:
+        return None
+
+    result = match_template_window(plan, rotated_template, rotated_mask, x_start, y_start, x_end, y_end, engine)
+    _, max_value, _, max_location = cv2.minMaxLoc(result)
+    if max_value < threshold:
+        return None
+    return (x_start + max_location[0], y_start + max_location[1]), max_value
+
+
+def find_angle_peaks(plan, template, angle, elements_amount, threshold, pyramid_levels=0, coarse_template=None,
+                     engine='opencv', search_area=None, refine_peaks=True):
+    # Rotate the template, rotations of already searched templates are taken from the bank
+    rotated_template, rotated_mask = rotated_template_bank.get_rotated_template_and_mask(template, angle)
+
+    # Get template width and height
+    rotated_template_height, rotated_template_width = rotated_template.shape
+
+    if pyramid_levels > 0:
+        pyramid_scale = 2 ** pyramid_levels
+        coarse_rotated_template, coarse_rotated_mask = rotated_template_bank.get_rotated_template_and_mask(
+            coarse_template, angle)
+        coarse_image = plan.get_level(pyramid_levels)
+        if coarse_rotated_template.shape[0] > coarse_image.shape[0] \
+                or coarse_rotated_template.shape[1] > coarse_image.shape[1]:
+            return []
+        result = plan.match_template(coarse_rotated_template, coarse_rotated_mask, pyramid_levels, engine)
+        if search_area is not None:
+            # Coarse position is not exact, so the area is widened by the refinement window
+            result = np.nan_to_num(result, nan=0, posinf=0, neginf=0)
+            result[~search_area.get_result_mask(rotated_template.shape, result.shape, scale=pyramid_scale,
+                                                dilation=PYRAMID_REFINE_RADIUS * pyramid_scale)] = 0
+        if not refine_peaks:
+            # Coarse peaks are refined by the caller
+            coarse_loc = find_top_peaks(result, threshold, elements_amount,
+                                        max(min(coarse_rotated_template.shape) // 2, 3))
+            loc = (coarse_loc[0] * pyramid_scale, coarse_loc[1] * pyramid_scale)
+            return [((int(pt[0] + rotated_template_width / 2), int(pt[1] + rotated_template_height / 2)), angle,
+                     float(score)) for pt, score in zip(zip(*loc[::-1]), result[coarse_loc])]
+
+        coarse_threshold = threshold - PYRAMID_THRESHOLD_SLACK * pyramid_levels
+        coarse_loc = find_top_peaks(result, coarse_threshold, elements_amount * PYRAMID_CANDIDATES_FACTOR,
+                                    max(min(coarse_rotated_template.shape) // 2, 3))
+
+        # Coarse peak position is known only up to the pyramid scale, so it is searched in a small window
+        refined_points = {}
+        for coarse_pt in zip(*coarse_loc[::-1]):
+            pt = (int(coarse_pt[0] * pyramid_scale), int(coarse_pt[1] * pyramid_scale))
+            refined_peak = refine_pyramid_peak(plan, rotated_template, rotated_mask, pt,
+                                               PYRAMID_REFINE_RADIUS * pyramid_scale, threshold, engine)
+            if refined_peak is not None:
+                refined_pt, score = refined_peak
+                if search_area is not None and not search_area.get_mask()[
+                        refined_pt[1] + rotated_template_height // 2, refined_pt[0] + rotated_template_width // 2]:
+                    continue
+                refined_points[refined_pt] = score
+        refined_points = sorted(refined_points.items(), key=lambda item: (item[0][1], item[0][0]))
+        loc = (np.array([point[1] for point, score in refined_points], dtype=np.intp),
+               np.array([point[0] for point, score in refined_points], dtype=np.intp))
+        scores = [score for point, score in refined_points]
+    else:
+        if rotated_template.shape[0] > plan.image.shape[0] or rotated_template.shape[1] > plan.image.shape[1]:
+            return []
+        if search_area is not None:
+            loc, scores = find_search_area_peaks(plan, rotated_template, rotated_mask, search_area, elements_amount,
+                                                 threshold, engine)
+        else:
+            result = plan.match_template(rotated_template, rotated_mask, engine=engine)
+            loc = find_top_peaks(result, threshold, elements_amount, max(min(rotated_template.shape) // 2, 3))
+            scores = result[loc]
+
+    peaks = []
+    for pt, score in zip(zip(*loc[::-1]), scores):
+        # Calculate the bounding box center
+        center = int(pt[0] + rotated_template_width / 2), int(pt[1] + rotated_template_height / 2)
+        peaks.append((center, angle, float(score)))
+    return peaks
+
+
+def refine_variation_angle(plan, template, center, angle, angle_step, symmetry_period=360,
+                           radius=ANGLE_REFINE_RADIUS, engine='opencv'):
+    # Bisection of the angle around the coarse one, every angle is matched only in a small window around the center
+    evaluated_angles = {}
+
+    def evaluate(current_angle, current_center):
+        if current_angle not in evaluated_angles:
+            rotated_template, rotated_mask = rotated_template_bank.get_rotated_template_and_mask(
+                template, current_angle, exact_right_angles=False)
+            rotated_template_height, rotated_template_width = rotated_template.shape
+            pt = (current_center[0] - rotated_template_width // 2, current_center[1] - rotated_template_height // 2)
+            refined_peak = refine_pyramid_peak(plan, rotated_template, rotated_mask, pt, radius, -1, engine)
+            if refined_peak is None or not np.isfinite(refined_peak[1]):
+                evaluated_angles[current_angle] = (current_center, -1)
+            else:
+                (x, y), score = refined_peak
+                evaluated_angles[current_angle] = ((int(x + rotated_template_width / 2),
+                                                    int(y + rotated_template_height / 2)), float(score))
+        return evaluated_angles[current_angle]
+
+    best_angle = float(angle)
+    best_center, best_score = evaluate(best_angle, center)
+    delta = angle_step / 4
+    while delta >= ANGLE_REFINE_MIN_STEP:
+        for current_angle in (best_angle - delta, best_angle + delta):
+            current_center, score = evaluate(current_angle, best_center)
+            if score > best_score:
+                best_angle, best_center, best_score = current_angle, current_center, score
+        delta /= 2
+        radius = ANGLE_REFINE_RADIUS
+
+    # Sub-step angle is the vertex of the parabola through the best angle and its neighbours
+    delta *= 2
+    _, previous_score = evaluate(best_angle - delta, best_center)
+    _, next_score = evaluate(best_angle + delta, best_center)
+    curvature = previous_score - 2 * best_score + next_score
+    if curvature < 0:
+        best_angle += float(np.clip(delta * (previous_score - next_score) / (2 * curvature), -delta, delta))
+    return best_center, round(best_angle, 1) % symmetry_period, best_score
+
+
+def get_angle_refinement_errors(template, angles=(0.4, 2.0, 3.0, 44.2, 88.3, 90.0, 91.4, 178.5, 268.8, 358.9),
+                                angle_step=ANGLE_COARSE_STEP):
+    # Errors (in degrees) of the angles refined on the template drawn on blank paper at the given angles, used to
+    # check the angle refinement on real symbols. Symbols are rotated 4 times enlarged and reduced back, so they are
+    # drawn unlike the matched rotations of the template
     if len(template.shape) == 3:
         template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-
     template_height, template_width = template.shape
+    margin = max(template.shape)
+    enlarged_ink = cv2.resize(cv2.bitwise_not(template), None, fx=4, fy=4, interpolation=cv2.INTER_NEAREST)
+    enlarged_ink = cv2.copyMakeBorder(enlarged_ink, 4 * margin, 4 * margin, 4 * margin, 4 * margin,
+                                      cv2.BORDER_CONSTANT, value=0)
+    enlarged_center = ((enlarged_ink.shape[1] - 1) / 2, (enlarged_ink.shape[0] - 1) / 2)
+    errors = []
+    for angle in angles:
+        rotated_ink = cv2.warpAffine(enlarged_ink, cv2.getRotationMatrix2D(enlarged_center, angle, 1.0),
+                                     (enlarged_ink.shape[1], enlarged_ink.shape[0]))
+        image = cv2.bitwise_not(cv2.resize(rotated_ink, (template_width + 2 * margin, template_height + 2 * margin),
+                                           interpolation=cv2.INTER_AREA))
+        coarse_angle = round(angle / angle_step) * angle_step
+        _, refined_angle, _ = refine_variation_angle(PreparedPlan(image), template,
+                                                     (image.shape[1] // 2, image.shape[0] // 2), coarse_angle,
+                                                     angle_step, radius=ANGLE_REFINE_RADIUS * 2)
+        error = abs(refined_angle - angle) % 360
+        errors.append(round(min(error, 360 - error), 1))
+    return errors
+
+
+def init_matching_worker():
+    # Every worker process takes one core, so OpenCV internal threads would only compete with each other
+    cv2.setNumThreads(1)
+
+
+def attach_worker_array(role, shared_array_name, shape, dtype):
+    # Array is attached from the shared memory, the previous array of the same role is closed
+    shared_array = matching_worker_shared_arrays.get(role)
+    if shared_array is None or shared_array.name != shared_array_name:
+        if shared_array is not None:
+            shared_array.close()
+        shared_array = shared_memory.SharedMemory(name=shared_array_name)
+        matching_worker_shared_arrays[role] = shared_array
+    return np.ndarray(shape, dtype=dtype, buffer=shared_array.buf)
+
+
+def get_worker_plan(shared_image_name, shape, dtype):
+    # Plan image is attached from the shared memory once, its pyramid and spectra are reused by every task
+    global matching_worker_plan
+    shared_image = matching_worker_shared_arrays.get('plan')
+    if shared_image is None or shared_image.name != shared_image_name:
+        matching_worker_plan = None
+        matching_worker_plan = PreparedPlan(attach_worker_array('plan', shared_image_name, shape, dtype))
+    return matching_worker_plan
+
+
+def find_angles_chunk_peaks(shared_image_name, shape, dtype, template, angles, elements_amount, threshold,
+                            pyramid_levels, engine, search_area, shared_center_mask_name, refine_peaks):
+    # Plan is already thickened for the coarse sweep and the prefilter centers are found on the original plan
+    plan = get_worker_plan(shared_image_name, shape, dtype)
+    if shared_center_mask_name is not None:
+        search_area.attach_center_mask(attach_worker_array('center_mask', shared_center_mask_name, shape[:2], bool))
+    coarse_template = build_image_pyramid(template, pyramid_levels)[-1] if pyramid_levels > 0 else None
+    return [find_angle_peaks(plan, template, angle, elements_amount, threshold, pyramid_levels, coarse_template,
+                             engine, search_area, refine_peaks) for angle in angles]
+
+
+def get_matching_executor(workers):
+    # Worker processes are started once and reused by next searches
+    global matching_executor, matching_executor_workers
+    if matching_executor is None or matching_executor_workers != workers:
+        if matching_executor is not None:
+            matching_executor.shutdown()
+        matching_executor = ProcessPoolExecutor(max_workers=workers, initializer=init_matching_worker)
+        matching_executor_workers = workers
+    return matching_executor
+
+
+def shutdown_matching_executor():
+    # Worker processes are stopped before the interpreter exits, otherwise the pool is collected half torn down
+    global matching_executor, matching_executor_workers
+    if matching_executor is not None:
+        matching_executor.shutdown(cancel_futures=True)
+        matching_executor = None
+        matching_executor_workers = 0
+
+
+def find_peaks_in_parallel(plan, template, rotation_angles, elements_amount, threshold, pyramid_levels, engine,
+                           workers, search_area=None, ink_width=0, refine_peaks=True, cancel_event=None,
+                           chunk_peaks_callback=None):
+    # Plan image is placed into the shared memory instead of being pickled for every task. Thickened plan and
+    # the prefilter centers are prepared here once, so worker processes do not keep plan sized copies of them
+    search_plan = plan.get_thickened_plan(ink_width) if ink_width else plan
+    shared_image = search_plan.get_shared_image()
+    shared_center_mask_name = None
+    if search_area is not None and search_area.density_template is not None:
+        shared_center_mask_name = plan.get_shared_center_mask(search_area.density_template).name
+    angle_chunks = [chunk for chunk in np.array_split(rotation_angles, workers * MATCHING_CHUNKS_PER_WORKER)
+                    if len(chunk) > 0]
+    executor = get_matching_executor(workers)
+    futures = {executor.submit(find_angles_chunk_peaks, shared_image.name, search_plan.image.shape,
+                               search_plan.image.dtype.str, template, chunk, elements_amount, threshold,
+                               pyramid_levels, engine, search_area, shared_center_mask_name, refine_peaks): index
+               for index, chunk in enumerate(angle_chunks)}
+    # Finished chunks are reported at once, the rest are not started after the cancellation
+    chunks_peaks = [None] * len(angle_chunks)
+    for future in as_completed(futures):
+        chunk_peaks = future.result()
+        if chunk_peaks_callback is not None:
+            # Peaks processed by the callback are merged instead of the found ones
+            chunk_peaks = chunk_peaks_callback(chunk_peaks)
+        chunks_peaks[futures[future]] = chunk_peaks
+        if cancel_event is not None and cancel_event.is_set():
+            for pending_future in futures:
+                pending_future.cancel()
+            break
+    # Chunks are merged in the angle order, so the result does not depend on which worker finished first
+    angle_peaks = []
+    for chunk_peaks in chunks_peaks:
+        if chunk_peaks is not None:
+            angle_peaks.extend(chunk_peaks)
+    return angle_peaks
+
+
+def get_rotated_rectangles_overlap(rectangle_1, rectangle_2):
+    # Intersection over union of two rotated rectangles given as (center, size, angle)
+    intersection_type, intersection = cv2.rotatedRectangleIntersection(rectangle_1, rectangle_2)
+    if intersection_type == cv2.INTERSECT_NONE or intersection is None:
+        return 0
+    intersection_area = cv2.contourArea(cv2.convexHull(intersection))
+    union_area = rectangle_1[1][0] * rectangle_1[1][1] + rectangle_2[1][0] * rectangle_2[1][1] - intersection_area
+    return intersection_area / union_area if union_area > 0 else 0
+
+
+def suppress_overlapping_variations(variations, margin=NMS_CENTER_MARGIN, overlap_threshold=NMS_OVERLAP_THRESHOLD):
+    if len(variations) < 2:
+        return variations
+
+    centers = np.array([variation['center'] for variation in variations], dtype=np.float64)
+    sizes = np.array([variation['size'] for variation in variations], dtype=np.float64)
+    angles = np.array([variation['rotation_angle'] for variation in variations], dtype=np.float64)
+    scores = np.array([variation.get('score', 0) for variation in variations], dtype=np.float64)
+
+    # Kept variations are put into grid cells, so every candidate is compared only with its neighbours
+    reach = np.hypot(sizes[:, 0], sizes[:, 1])
+    cell_size = max(reach.max(), margin, 1)
+    cells = np.floor(centers / cell_size).astype(np.int64)
+    grid = {}
+
+    kept = []
+    for index in np.argsort(-scores, kind='stable'):
+        cell_x, cell_y = cells[index]
+        neighbours = [kept_index for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                      for kept_index in grid.get((cell_x + dx, cell_y + dy), ())]
+        is_suppressed = False
+        if neighbours:
+            neighbours = np.array(neighbours)
+            offsets = np.abs(centers[neighbours] - centers[index])
+            if np.any((offsets[:, 0] <= margin) & (offsets[:, 1] <= margin)):
+                is_suppressed = True
+            else:
+                # Exact rotated overlap is calculated only for boxes which can intersect at all
+                may_overlap = np.hypot(offsets[:, 0], offsets[:, 1]) < (reach[neighbours] + reach[index]) / 2
+                rectangle = (tuple(centers[index]), tuple(sizes[index]), angles[index])
+                for kept_index in neighbours[may_overlap]:
+                    kept_rectangle = (tuple(centers[kept_index]), tuple(sizes[kept_index]), angles[kept_index])
+                    if get_rotated_rectangles_overlap(rectangle, kept_rectangle) > overlap_threshold:
+                        is_suppressed = True
+                        break
+        if not is_suppressed:
+            kept.append(index)
+            grid.setdefault((cell_x, cell_y), []).append(index)
+
+    return [variations[index] for index in sorted(kept)]
+
+
+def get_scaled_template(template, scale):
+    if scale == 1:
+        return template
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(template, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def get_promising_scales(plan, template, scales, rotation_angles, threshold, engine='opencv'):
+    # Every scale is checked by a coarse sweep on the downsampled plan with thickened lines, scales without any good
+    # peak are not searched at full resolution
+    scale_scores = {}
+    for scale in scales:
+        scaled_template = get_scaled_template(template, scale)
+        ink_width = get_coarse_ink_width(scaled_template, engine)
+        screening_plan = plan.get_thickened_plan(ink_width) if ink_width else plan
+        screening_template = thicken_ink(scaled_template, ink_width) if ink_width else scaled_template
+        levels = get_pyramid_levels(screening_template, SCALE_SCREENING_LEVELS)
+        coarse_template = build_image_pyramid(screening_template, levels)[-1]
+        coarse_image = screening_plan.get_level(levels)
+        best_score = 0
+        best_prominence = 0
+        for angle in rotation_angles:
+            rotated_template, rotated_mask = rotated_template_bank.get_rotated_template_and_mask(coarse_template, angle)
+            if rotated_template.shape[0] > coarse_image.shape[0] or rotated_template.shape[1] > coarse_image.shape[1]:
+                continue
+            result = np.nan_to_num(screening_plan.match_template(rotated_template, rotated_mask, levels, engine),
+                                   nan=0, posinf=0, neginf=0)
+            # Wrong scales still match plain background well, but they do not give a distinct peak
+            max_score = float(result.max())
+            best_score = max(best_score, max_score)
+            best_prominence = max(best_prominence, max_score - float(np.percentile(result, 99)))
+        scale_scores[scale] = (best_score, best_prominence, levels)
+
+    promising_scales = [scale for scale, (score, prominence, levels) in scale_scores.items()
+                        if score >= threshold - SCALE_SCREENING_SLACK * max(levels, 1)
+                        and prominence >= SCALE_MIN_PROMINENCE]
+    if not promising_scales:
+        promising_scales = [max(scale_scores, key=lambda scale: scale_scores[scale][0])]
+    return promising_scales
+
+
+def find_scaled_template_peaks(plan, template, rotation_angles, elements_amount, threshold, pyramid_levels, workers,
+                               engine, search_area, angular_refinement, angle_step, symmetry_period,
+                               cancel_event=None, progress_callback=None):
+    # Coarse angular sweep runs on thickened lines and keeps the best candidates of every angle regardless of
+    # the threshold, their angles are refined and checked on the original plan afterwards
+    if angular_refinement:
+        ink_width = get_coarse_ink_width(template, engine)
+        search_template = thicken_ink(template, ink_width) if ink_width else template
+        search_threshold = ANGLE_COARSE_MIN_SCORE
+        search_elements_amount = elements_amount * ANGLE_COARSE_CANDIDATES_FACTOR
+    else:
+        ink_width = 0
+        search_template = template
+        search_threshold = threshold
+        search_elements_amount = elements_amount
+
+    # Coarse-to-fine search: match on the downsampled plan first, then only around found peaks
+    pyramid_levels = get_pyramid_levels(template, pyramid_levels)
+
+    # Peaks of every finished angle are refined and reported at once, so they can be shown before the end of the search
+    def add_angle_peaks(angle_peaks):
+        peaks = [peak for peaks in angle_peaks for peak in peaks]
+        if angular_refinement:
+            # Coarse pyramid peaks are not refined yet, so their first window covers the pyramid cell
+            refine_radius = max(ANGLE_REFINE_RADIUS, PYRAMID_REFINE_RADIUS * 2 ** pyramid_levels)
+            refined_peaks = []
+            for center, angle, score in peaks:
+                center, angle, score = refine_variation_angle(plan, template, center, angle, angle_step,
+                                                              symmetry_period, refine_radius, engine)
+                if score >= threshold:
+                    refined_peaks.append((center, angle, score))
+            peaks = refined_peaks
+        if progress_callback is not None:
+            progress_callback(len(angle_peaks), peaks)
+        return peaks
+
+    # Angles are independent, so they can be spread across worker processes
+    if workers > 1:
+        found_peaks = find_peaks_in_parallel(plan, search_template, rotation_angles, search_elements_amount,
+                                             search_threshold, pyramid_levels, engine, workers, search_area, ink_width,
+                                             not angular_refinement, cancel_event, add_angle_peaks)
+    else:
+        found_peaks = []
+        search_plan = plan.get_thickened_plan(ink_width) if ink_width else plan
+        coarse_template = build_image_pyramid(search_template, pyramid_levels)[-1] if pyramid_levels > 0 else None
+        for angle in rotation_angles:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            found_peaks.extend(add_angle_peaks([find_angle_peaks(search_plan, search_template, angle,
+                                                                 search_elements_amount, search_threshold,
+                                                                 pyramid_levels, coarse_template, engine, search_area,
+                                                                 not angular_refinement)]))
+    return found_peaks
+
+
+class DetectionCache:
+    # Found variations are stored on the disk, so the repeated search of the same plan and template is instant.
+    # Least recently used entries are removed when the cache grows too large
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def get_key(self, **search_parameters):
+        key = json.dumps(search_parameters, sort_keys=True, default=lambda value: value.item())
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, encoding='utf-8') as file:
+                variations = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        for variation in variations:
+            variation['center'] = tuple(variation['center'])
+            variation['size'] = tuple(variation['size'])
+        return variations
+
+    def put(self, key, variations):
+        path = self.get_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Entry is written under a temporary name first, so a broken write never looks like a cached result
+            with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(variations, file, default=lambda value: value.item())
+            os.replace(path + '.tmp', path)
+            self.evict()
+        except OSError as error:
+            print(f'Detection cache is not written: {error}')
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.json'):
+                path = os.path.join(self.directory, file_name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        entries.sort()
+        used_bytes = sum(size for modification_time, size, path in entries)
+        for modification_time, size, path in entries:
+            if used_bytes <= self.max_bytes and time.time() - modification_time <= self.max_age:
+                break
+            os.remove(path)
+            used_bytes -= size
 
-    # Set a threshold for template matching results
-    threshold = threshold
-    rotation_angles = np.arange(0, 360, 5)  # Rotation angles to consider
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for file_name in os.listdir(self.directory):
+                if file_name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, file_name))
 
-    # Find template variations
-    template_variations = []
 
-    for angle in rotation_angles:
-        # Rotate the template
-        rotated_template, rotated_mask = rotate_template_and_get_mask(template, angle)
+detection_cache = DetectionCache(DETECTION_CACHE_DIRECTORY, DETECTION_CACHE_MAX_BYTES, DETECTION_CACHE_MAX_AGE)
 
-        # Get template width and height
-        rotated_template_height, rotated_template_width = rotated_template.shape
 
-        result = cv2.matchTemplate(image, rotated_template, cv2.TM_CCORR_NORMED, mask=rotated_mask)
-        loc = np.where(result >= threshold)
-        local_threshold = threshold
-        while len(loc[0]) > elements_amount*2:
-            local_threshold += 0.01
-            loc = np.where(result >= local_threshold)
+def find_template_variations(image, template, furniture_name, elements_amount, threshold=0.96, pyramid_levels=0,
+                             workers=0, engine='opencv', orientations=None, search_area=None,
+                             angular_refinement=True, scales=(1.0,), ink_density_prefilter=False, cache=None,
+                             cancel_event=None, progress_callback=None):
 
-        for pt in zip(*loc[::-1]):
-            # Calculate the bounding box coordinates
-            center = int(pt[0] + rotated_template_width / 2), int(pt[1] + rotated_template_height / 2)
-            variation = {
-                'center': center,
-                'size': (template_width, template_height),
-                # 'scale': scale,
-                'rotation_angle': angle,
-                'furniture_name': furniture_name
-            }
-            template_variations.append(variation)
+    # Preprocess image and template, the plan may be already prepared by a search of several templates
+    is_own_plan = not isinstance(image, PreparedPlan)
+    plan = PreparedPlan(image) if is_own_plan else image
+    # ret, image = cv2.threshold(image_gray, 125, 255, cv2.THRESH_BINARY)
+    if len(template.shape) == 3:
+        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+
+    # Set a threshold for template matching results
+    threshold = threshold
+    angle_step = ANGLE_COARSE_STEP if angular_refinement else ANGLE_STEP
+    rotation_angles = np.arange(0, 360, angle_step)  # Rotation angles to consider
+
+    # Angles which differ by the symmetry period give the same rotated template, so only the first period is searched
+    # and found rotation angles are already reduced to it
+    symmetry_period = get_rotational_symmetry_period(template)
+    rotation_angles = rotation_angles[rotation_angles < symmetry_period]
+
+    # Elements are placed along the walls, so on plans with known wall directions only those angles are searched
+    if orientations:
+        rotation_angles = restrict_rotation_angles(rotation_angles, orientations, angle_step / 2)
+
+    # Same search of the same plan was already done, its variations are taken from the cache
+    if cache is not None:
+        cache_key = cache.get_key(
+            plan=plan.get_hash(), template=get_template_hash(template), furniture_name=furniture_name,
+            elements_amount=elements_amount, threshold=threshold, angles=[float(angle) for angle in rotation_angles],
+            engine=engine, engine_version=DETECTION_ENGINE_VERSION, pyramid_levels=pyramid_levels,
+            scales=[float(scale) for scale in scales], angular_refinement=angular_refinement,
+            ink_density_prefilter=ink_density_prefilter,
+            search_area=None if search_area is None else [search_area.walls, search_area.band_width,
+                                                          search_area.excluded_rectangles])
+        cached_variations = cache.get(cache_key)
+        if cached_variations is not None:
+            if is_own_plan:
+                plan.release()
+            if progress_callback is not None:
+                progress_callback(1, 1, cached_variations)
+            print(f'Were found {len(cached_variations)} cached variations of {furniture_name}')
+            return cached_variations
+
+    # Find template variations, the plan with its pyramid and spectra is shared by all scales
+    template_variations = []
+    positions_amount = 0
+    pruned_positions_amount = 0
+    try:
+        if len(scales) > 1:
+            scales = get_promising_scales(plan, template, scales, rotation_angles, threshold, engine)
+        steps_amount = len(scales) * len(rotation_angles)
+        steps_done = 0
+        for scale in scales:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            scaled_template = get_scaled_template(template, scale)
+            template_height, template_width = scaled_template.shape
+
+            # Positions with too little or too much ink around them are skipped before any correlation
+            scale_search_area = search_area
+            if ink_density_prefilter:
+                scale_search_area = get_ink_density_search_area(plan, scaled_template, search_area)
+                scale_positions_amount = search_area.get_positions_amount() if search_area is not None \
+                    else plan.image.size
+                positions_amount += scale_positions_amount
+                pruned_positions_amount += scale_positions_amount - scale_search_area.get_positions_amount()
+
+            def get_variations(peaks):
+                return [{
+                    'center': center,
+                    'size': (template_width, template_height),
+                    'scale': scale,
+                    'rotation_angle': angle,
+                    'furniture_name': furniture_name,
+                    'score': score
+                } for center, angle, score in peaks]
+
+            # Reported peaks arrive in the order the workers finish, they are used only to show the progress
+            reported_variations = []
+
+            def add_peaks(angles_amount, peaks):
+                nonlocal steps_done
+                reported_variations.extend(get_variations(peaks))
+                steps_done += angles_amount
+                # Variations found so far are reported without overlapping ones
+                if progress_callback is not None:
+                    progress_callback(steps_done, steps_amount,
+                                      suppress_overlapping_variations(template_variations + reported_variations))
+
+            template_variations.extend(get_variations(find_scaled_template_peaks(
+                plan, scaled_template, rotation_angles, elements_amount, threshold, pyramid_levels, workers, engine,
+                scale_search_area, angular_refinement, angle_step, symmetry_period, cancel_event, add_peaks)))
+    finally:
+        if is_own_plan:
+            plan.release()
+
+    # Keep only the best scored variation of every overlapping group
+    template_variations = suppress_overlapping_variations(template_variations)
+    # Cancelled search has found only a part of the variations
+    if cache is not None and not (cancel_event is not None and cancel_event.is_set()):
+        cache.put(cache_key, template_variations)
+
+    if ink_density_prefilter:
+        print(f'Ink density prefilter pruned {pruned_positions_amount} of {positions_amount} positions '
+              f'of {furniture_name}')
+    print(f'Were found {len(template_variations)} variations of {furniture_name}')
+    return template_variations
 
-    margin = 5
 
-    filtered_array = []
-    for i, dict1 in enumerate(template_variations):
-        is_close = False
-        for j, dict2 in enumerate(template_variations[i + 1:]):
-            if abs(dict1['center'][0] - dict2['center'][0]) <= margin and abs(
-                    dict1['center'][1] - dict2['center'][1]) <= margin:
-                is_close = True
+def find_all_template_variations(image, templates, elements_amounts, threshold=0.96, pyramid_levels=0, workers=0,
+                                 engine='opencv', orientations=None, search_areas=None, scales=(1.0,),
+                                 ink_density_prefilter=False, cache=None, cancel_event=None, progress_callback=None):
+    # Plan is preprocessed once, its grayscale image, pyramid, spectra and shared memory are used by all templates
+    plan = PreparedPlan(image)
+    found_variations = {}
+    try:
+        for template_index, (furniture_name, template) in enumerate(templates.items()):
+            if cancel_event is not None and cancel_event.is_set():
                 break
-        if not is_close:
-            filtered_array.append(dict1)
 
-    template_variations = filtered_array
+            def report_progress(steps_done, steps_amount, variations):
+                # Every template takes an equal part of the total progress
+                progress_callback(template_index * steps_amount + steps_done, len(templates) * steps_amount,
+                                  variations)
+
+            found_variations[furniture_name] = find_template_variations(
+                plan, template, furniture_name, elements_amounts[furniture_name], threshold=threshold,
+                pyramid_levels=pyramid_levels, workers=workers, engine=engine, orientations=orientations,
+                search_area=search_areas.get(furniture_name) if search_areas else None, scales=scales,
+                ink_density_prefilter=ink_density_prefilter, cache=cache, cancel_event=cancel_event,
+                progress_callback=report_progress if progress_callback else None)
+    finally:
+        plan.release()
+    return found_variations
+
+
+def apply_filter_stage(image, stage):
+    operation, value = stage
+    if operation == 'gray':
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if operation == 'threshold':
+        return cv2.threshold(image, value, 255, cv2.THRESH_BINARY)[1]
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (value, value))
+    if operation == 'dilate':
+        return cv2.dilate(image, kernel, iterations=1)
+    return cv2.erode(image, kernel, iterations=1)
+
+
+class FilterPipeline:
+    # Results of every filter stage of the last run are kept, so a changed stage is recomputed only with the stages
+    # after it
+    def __init__(self):
+        self.source = None
+        self.stages = []
+        self.results = []
+        # Pipeline is used both by the GUI thread and by the preview thread
+        self.lock = threading.Lock()
+
+    def apply(self, image, stages):
+        with self.lock:
+            return self.apply_stages(image, stages)
+
+    def apply_stages(self, image, stages):
+        if image is not self.source:
+            self.source = image
+            self.stages = []
+            self.results = []
+        reused_amount = 0
+        for stage, previous_stage in zip(stages, self.stages):
+            if stage != previous_stage:
+                break
+            reused_amount += 1
 
-    print(f'Were found {len(template_variations)} variations of {furniture_name}')
-    return template_variations
+        results = self.results[:reused_amount]
+        for stage in stages[reused_amount:]:
+            result = apply_filter_stage(results[-1] if results else image, stage)
+            result.flags.writeable = False
+            results.append(result)
+        self.stages = list(stages)
+        self.results = results
+        return results[-1] if results else image
+
+
+def get_corner_centroids(corners_response, quality_level):
+    # Every blob of the strong Harris response is one corner, its centroid is refined afterwards
+    strong_response = (corners_response > quality_level * corners_response.max()).astype(np.uint8)
+    _, _, _, centroids = cv2.connectedComponentsWithStats(strong_response, connectivity=8)
+    # First component is the background
+    return np.float32(centroids[1:])
 
 
 def is_corner_in_walls(walls, corner):
@@ -164,7 +1455,15 @@ class Ui_MainWindow(object):
         self.KERNEL_SPIN_BOX_MAX_VAL = 15
         self.KERNEL_SPIN_BOX_STEP = 1
         self.IMAGE_UPSCALE_RATE = 3
+        self.NATIVE_RESOLUTION_PROCESSING = False  # Plan is processed in its own resolution, the display is enlarged
         self.SELECTING_TOLERANCE = 5
+        self.TEMPLATE_PYRAMID_LEVELS = 2  # Downsampling levels for coarse-to-fine template search, 0 - disabled
+        # Processes for template search, 1 - serial
+        self.TEMPLATE_MATCHING_WORKERS = max(min((os.cpu_count() or 1) - 1, MATCHING_MAX_WORKERS), 1)
+        self.TEMPLATE_SCALES = (0.8, 0.9, 1.0, 1.1, 1.25)  # Template sizes relative to the region of interest
+        self.SEARCH_CANDIDATES_THRESHOLD = 0.8  # Searches keep candidates down to this score, shown ones are filtered
+        self.FILTER_PREVIEW_DELAY = 50  # Filters are recomputed when their parameters do not change for this time (ms)
+        self.FILTER_PREVIEW_LOW_RESOLUTION = True  # Filtered plan of the original resolution is shown first
 
         self.furniture_list = import_xlsx_config()
         self.setup_ui(MainWindow)
@@ -188,7 +1487,12 @@ class Ui_MainWindow(object):
 
         self.image_with_corners = None
         self.filtered_image = None
+        self.filtered_preview_image = None
         self.filtered_image_with_corners = None
+        # Dominant orientations of the plan with the image they were computed on
+        self.plan_orientations = (None, None)
+        self.corners_response = None
+        self.corners_response_image = None
         self.image_with_rectangle = None
         self.corners_found = False
         self.corners = []
@@ -202,6 +1506,8 @@ class Ui_MainWindow(object):
         self.dilate_1 = False
         self.erode_1 = False
         self.scale_factor = 1
+        # Pixels of the working image per pixel of the imported plan, all coordinates are in the working image
+        self.working_scale = self.IMAGE_UPSCALE_RATE
         self.horizontal_image_size_scale = 1.0
         self.vertical_image_size_scale = 1.0
         self.real_sizes_are_shown = False
@@ -240,6 +1546,21 @@ class Ui_MainWindow(object):
         self.found_furniture = None
         self.confirmed_furniture = None
         self.draw_region_of_interest = False
+        self.element_templates = {}
+        self.found_candidates = {}
+        self.rejected_candidates = set()
+        self.search_thread = None
+        self.filter_pipeline = FilterPipeline()
+
+        # Filter previews computed in the background, rapid parameter changes are coalesced by the timer
+        self.preview_filter_pipeline = FilterPipeline()
+        self.filter_preview_timer = QtCore.QTimer()
+        self.filter_preview_timer.setSingleShot(True)
+        self.filter_preview_timer.timeout.connect(self.start_filter_preview)
+        self.filter_preview_thread = None
+        self.filter_generation = 0
+        self.filter_preview_pending = False
+        self.searched_furniture_names = []
 
         # Exporting data
         self.adjusted_walls = []
@@ -1038,6 +2359,64 @@ class Ui_MainWindow(object):
         self.increase_roi_height_push_button.setObjectName("increase_roi_height_push_button")
         self.horizontalLayout_24.addWidget(self.increase_roi_height_push_button)
         self.verticalLayout_7.addLayout(self.horizontalLayout_24)
+        self.horizontalLayout_31 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_31.setObjectName("horizontalLayout_31")
+        self.matching_engine_label = QtWidgets.QLabel(self.frame_3)
+        self.matching_engine_label.setObjectName("matching_engine_label")
+        self.horizontalLayout_31.addWidget(self.matching_engine_label)
+        spacerItem38 = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
+        self.horizontalLayout_31.addItem(spacerItem38)
+        self.matching_engine_combo_box = QtWidgets.QComboBox(self.frame_3)
+        self.matching_engine_combo_box.setSizeAdjustPolicy(QtWidgets.QComboBox.AdjustToContentsOnFirstShow)
+        self.matching_engine_combo_box.setObjectName("matching_engine_combo_box")
+        self.matching_engine_combo_box.addItem("")
+        self.matching_engine_combo_box.addItem("")
+        self.matching_engine_combo_box.addItem("")
+        self.horizontalLayout_31.addWidget(self.matching_engine_combo_box)
+        self.verticalLayout_7.addLayout(self.horizontalLayout_31)
+        self.horizontalLayout_32 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_32.setObjectName("horizontalLayout_32")
+        self.dominant_orientations_check_box = QtWidgets.QCheckBox(self.frame_3)
+        self.dominant_orientations_check_box.setChecked(True)
+        self.dominant_orientations_check_box.setObjectName("dominant_orientations_check_box")
+        self.horizontalLayout_32.addWidget(self.dominant_orientations_check_box)
+        self.template_scales_check_box = QtWidgets.QCheckBox(self.frame_3)
+        self.template_scales_check_box.setChecked(False)
+        self.template_scales_check_box.setObjectName("template_scales_check_box")
+        self.horizontalLayout_32.addWidget(self.template_scales_check_box)
+        self.ink_density_prefilter_check_box = QtWidgets.QCheckBox(self.frame_3)
+        self.ink_density_prefilter_check_box.setChecked(True)
+        self.ink_density_prefilter_check_box.setObjectName("ink_density_prefilter_check_box")
+        self.horizontalLayout_32.addWidget(self.ink_density_prefilter_check_box)
+        spacerItem39 = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
+        self.horizontalLayout_32.addItem(spacerItem39)
+        self.verticalLayout_7.addLayout(self.horizontalLayout_32)
+        self.horizontalLayout_34 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_34.setObjectName("horizontalLayout_34")
+        self.search_threshold_label = QtWidgets.QLabel(self.frame_3)
+        self.search_threshold_label.setObjectName("search_threshold_label")
+        self.horizontalLayout_34.addWidget(self.search_threshold_label)
+        spacerItem40 = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
+        self.horizontalLayout_34.addItem(spacerItem40)
+        self.search_threshold_spin_box = QtWidgets.QDoubleSpinBox(self.frame_3)
+        self.search_threshold_spin_box.setMinimum(self.SEARCH_CANDIDATES_THRESHOLD)
+        self.search_threshold_spin_box.setMaximum(1.0)
+        self.search_threshold_spin_box.setSingleStep(0.01)
+        self.search_threshold_spin_box.setProperty("value", 0.9)
+        self.search_threshold_spin_box.setObjectName("search_threshold_spin_box")
+        self.horizontalLayout_34.addWidget(self.search_threshold_spin_box)
+        self.verticalLayout_7.addLayout(self.horizontalLayout_34)
+        self.horizontalLayout_33 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_33.setObjectName("horizontalLayout_33")
+        self.search_progress_bar = QtWidgets.QProgressBar(self.frame_3)
+        self.search_progress_bar.setProperty("value", 0)
+        self.search_progress_bar.setObjectName("search_progress_bar")
+        self.horizontalLayout_33.addWidget(self.search_progress_bar)
+        self.cancel_search_push_button = QtWidgets.QPushButton(self.frame_3)
+        self.cancel_search_push_button.setEnabled(False)
+        self.cancel_search_push_button.setObjectName("cancel_search_push_button")
+        self.horizontalLayout_33.addWidget(self.cancel_search_push_button)
+        self.verticalLayout_7.addLayout(self.horizontalLayout_33)
 
         self.line_6 = QtWidgets.QFrame(self.frame_3)
         self.line_6.setFrameShape(QtWidgets.QFrame.HLine)
@@ -1302,6 +2681,14 @@ class Ui_MainWindow(object):
         self.confirm_furniture_push_button.setSizePolicy(sizePolicy)
         self.confirm_furniture_push_button.setObjectName("confirm_furniture_push_button")
         self.verticalLayout_7.addWidget(self.confirm_furniture_push_button)
+        self.find_all_elements_push_button = QtWidgets.QPushButton(self.frame_3)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.find_all_elements_push_button.sizePolicy().hasHeightForWidth())
+        self.find_all_elements_push_button.setSizePolicy(sizePolicy)
+        self.find_all_elements_push_button.setObjectName("find_all_elements_push_button")
+        self.verticalLayout_7.addWidget(self.find_all_elements_push_button)
         spacerItem37 = QtWidgets.QSpacerItem(17, 17, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.verticalLayout_7.addItem(spacerItem37)
         self.gridLayout_7.addWidget(self.frame_3, 0, 0, 1, 1)
@@ -1426,6 +2813,15 @@ class Ui_MainWindow(object):
         self.roi_height_control_label.setText(_translate("MainWindow", "Глубина"))
         self.decrease_roi_height_push_button.setText(_translate("MainWindow", "-"))
         self.increase_roi_height_push_button.setText(_translate("MainWindow", "+"))
+        self.matching_engine_label.setText(_translate("MainWindow", "Алгоритм поиска"))
+        self.matching_engine_combo_box.setItemText(0, _translate("MainWindow", "Корреляция OpenCV"))
+        self.matching_engine_combo_box.setItemText(1, _translate("MainWindow", "Корреляция через FFT"))
+        self.matching_engine_combo_box.setItemText(2, _translate("MainWindow", "Chamfer по контурам"))
+        self.dominant_orientations_check_box.setText(_translate("MainWindow", "Искать только вдоль направлений стен"))
+        self.template_scales_check_box.setText(_translate("MainWindow", "Искать разные размеры"))
+        self.ink_density_prefilter_check_box.setText(_translate("MainWindow", "Пропускать пустые места"))
+        self.search_threshold_label.setText(_translate("MainWindow", "Порог совпадения"))
+        self.cancel_search_push_button.setText(_translate("MainWindow", "Отменить поиск"))
         self.windows_label.setText(_translate("MainWindow", "Окна"))
         self.window_casements_label.setText(_translate("MainWindow", "Количество створок"))
         self.windows_to_find_label.setText(_translate("MainWindow", "Количество окон для нахождения"))
@@ -1459,6 +2855,7 @@ class Ui_MainWindow(object):
         self.add_furniture_radio_button.setText(_translate("MainWindow", "Добавить мебель"))
         self.delete_furniture_radio_button.setText(_translate("MainWindow", "Удалить мебель"))
         self.confirm_furniture_push_button.setText(_translate("MainWindow", "Подтвердить выделенную мебель"))
+        self.find_all_elements_push_button.setText(_translate("MainWindow", "Найти все элементы по образцам"))
 
     # Connecting signals with methods
     def setup_connection(self):
@@ -1475,27 +2872,28 @@ class Ui_MainWindow(object):
         self.apply_size_push_button.clicked.connect(self.apply_real_dimensions)
 
         # Corners tab
-        self.threshold_maxval.valueChanged.connect(self.corners_filters)
+        self.threshold_maxval.valueChanged.connect(self.schedule_filter_preview)
 
-        self.dilate_1_check_box.stateChanged.connect(self.corners_filters)
-        self.dilate_1_spin_box.valueChanged.connect(self.corners_filters)
+        self.dilate_1_check_box.stateChanged.connect(self.schedule_filter_preview)
+        self.dilate_1_spin_box.valueChanged.connect(self.schedule_filter_preview)
         self.dilate_1_spin_box.valueChanged.connect(lambda: self.dilate_1_check_box.setChecked(True))
 
-        self.erode_1_check_box.stateChanged.connect(self.corners_filters)
-        self.erode_1_spin_box.valueChanged.connect(self.corners_filters)
+        self.erode_1_check_box.stateChanged.connect(self.schedule_filter_preview)
+        self.erode_1_spin_box.valueChanged.connect(self.schedule_filter_preview)
         self.erode_1_spin_box.valueChanged.connect(lambda: self.erode_1_check_box.setChecked(True))
 
-        self.dilate_2_check_box.stateChanged.connect(self.corners_filters)
-        self.dilate_2_spin_box.valueChanged.connect(self.corners_filters)
+        self.dilate_2_check_box.stateChanged.connect(self.schedule_filter_preview)
+        self.dilate_2_spin_box.valueChanged.connect(self.schedule_filter_preview)
         self.dilate_2_spin_box.valueChanged.connect(lambda: self.dilate_2_check_box.setChecked(True))
 
-        self.erode_2_check_box.stateChanged.connect(self.corners_filters)
-        self.erode_2_spin_box.valueChanged.connect(self.corners_filters)
+        self.erode_2_check_box.stateChanged.connect(self.schedule_filter_preview)
+        self.erode_2_spin_box.valueChanged.connect(self.schedule_filter_preview)
         self.erode_2_spin_box.valueChanged.connect(lambda: self.erode_2_check_box.setChecked(True))
 
         self.show_filters_check_box.stateChanged.connect(self.set_image)
 
         self.find_corners_push_button.clicked.connect(self.find_corners)
+        self.quality_level_spin_box.valueChanged.connect(self.update_corners_quality)
 
         self.add_corner_radio_button.toggled.connect(self.set_corners_found)
         self.confirm_corners_push_button.clicked.connect(self.confirm_corners)
@@ -1519,6 +2917,12 @@ class Ui_MainWindow(object):
         self.find_furniture_push_button.clicked.connect(lambda:
                     self.find_furniture(self.furniture_list[self.furniture_type_combo_box.currentIndex()]['Тип мебели']))
         self.confirm_furniture_push_button.clicked.connect(self.confirm_furniture)
+        self.find_all_elements_push_button.clicked.connect(self.find_all_elements)
+        self.cancel_search_push_button.clicked.connect(self.cancel_search)
+        self.search_threshold_spin_box.valueChanged.connect(self.filter_found_variations)
+        self.windows_to_find_spin_box.valueChanged.connect(self.filter_found_variations)
+        self.doors_to_find_spin_box.valueChanged.connect(self.filter_found_variations)
+        self.furniture_to_find_spin_box.valueChanged.connect(self.filter_found_variations)
 
         # Scale slider
         self.scale_slider.valueChanged.connect(self.update_image_scale)
@@ -1540,7 +2944,12 @@ class Ui_MainWindow(object):
             self.reinitialize_data()
             self.image_path = file_path
             self.initial_image = cv2.imread(self.image_path)
-            self.image = cv2.resize(self.initial_image, None, fx=self.IMAGE_UPSCALE_RATE, fy=self.IMAGE_UPSCALE_RATE)
+            # Filters, corners and drawings work on this image, the display shows it at the same size in both modes
+            self.working_scale = 1 if self.NATIVE_RESOLUTION_PROCESSING else self.IMAGE_UPSCALE_RATE
+            if self.working_scale == 1:
+                self.image = self.initial_image
+            else:
+                self.image = cv2.resize(self.initial_image, None, fx=self.working_scale, fy=self.working_scale)
             self.image_with_interior_elements = self.image.copy()
             self.corners_filters()
             self.show_filters_check_box.setChecked(False)
@@ -1567,7 +2976,7 @@ class Ui_MainWindow(object):
                 converted_window = {
                     f'{i + 1}_center': tuple(self.adjust_coordinate(window['center'])),
                     f'{i + 1}_size': tuple(self.adjust_furniture_size(window['size'])),
-                    f'{i + 1}_rotation_angle': int(window['rotation_angle']),
+                    f'{i + 1}_rotation_angle': round(float(window['rotation_angle']), 1),
                     f'{i + 1}_furniture_name': window['furniture_name'],
                     f'{i + 1}_casements': window['casements']
                 }
@@ -1579,7 +2988,7 @@ class Ui_MainWindow(object):
                 converted_door = {
                     f'{i + 1}_center': tuple(self.adjust_coordinate(door['center'])),
                     f'{i + 1}_size': tuple(self.adjust_furniture_size(door['size'])),
-                    f'{i + 1}_rotation_angle': int(door['rotation_angle']),
+                    f'{i + 1}_rotation_angle': round(float(door['rotation_angle']), 1),
                     f'{i + 1}_furniture_name': door['furniture_name'],
                     f'{i + 1}_door_type': door['door_type']
                 }
@@ -1591,7 +3000,7 @@ class Ui_MainWindow(object):
                 converted_interior_element = {
                     f'{i + 1}_center': tuple(self.adjust_coordinate(interior_element['center'])),
                     f'{i + 1}_size': tuple(self.adjust_furniture_size(interior_element['size'])),
-                    f'{i + 1}_rotation_angle': int(interior_element['rotation_angle']),
+                    f'{i + 1}_rotation_angle': round(float(interior_element['rotation_angle']), 1),
                     f'{i + 1}_furniture_name': interior_element['furniture_name']
                 }
                 converted_furniture.append(converted_interior_element)
@@ -1639,7 +3048,12 @@ class Ui_MainWindow(object):
 
         self.image_with_corners = None
         self.filtered_image = None
+        self.filtered_preview_image = None
         self.filtered_image_with_corners = None
+        # Dominant orientations of the plan with the image they were computed on
+        self.plan_orientations = (None, None)
+        self.corners_response = None
+        self.corners_response_image = None
         self.image_with_rectangle = None
         self.corners_found = False
         self.corners = []
@@ -1651,6 +3065,8 @@ class Ui_MainWindow(object):
         self.dilate_1 = False
         self.erode_1 = False
         self.scale_factor = 1
+        # Pixels of the working image per pixel of the imported plan, all coordinates are in the working image
+        self.working_scale = self.IMAGE_UPSCALE_RATE
         self.horizontal_image_size_scale = 1.0
         self.vertical_image_size_scale = 1.0
         self.real_sizes_are_shown = False
@@ -1689,6 +3105,9 @@ class Ui_MainWindow(object):
         self.found_furniture = None
         self.confirmed_furniture = None
         self.draw_region_of_interest = False
+        self.element_templates = {}
+        self.found_candidates = {}
+        self.rejected_candidates = set()
 
         # Exporting data
         self.adjusted_walls = []
@@ -1716,7 +3135,10 @@ class Ui_MainWindow(object):
                     else:
                         if self.filtered_image is None:
                             self.corners_filters()
-                        frame = cv2.cvtColor(self.filtered_image, cv2.COLOR_GRAY2RGB)
+                        if self.filtered_preview_image is not None:
+                            frame = cv2.cvtColor(self.filtered_preview_image, cv2.COLOR_GRAY2RGB)
+                        else:
+                            frame = cv2.cvtColor(self.filtered_image, cv2.COLOR_GRAY2RGB)
                 else:
                     if self.corners_found:
                         frame = cv2.cvtColor(self.image_with_corners, cv2.COLOR_BGR2RGB)
@@ -1733,7 +3155,8 @@ class Ui_MainWindow(object):
     def update_image_scale(self):
         if self.image is not None:
             old_scale_factor = self.scale_factor
-            self.scale_factor = self.scale_slider.value() / 200
+            # Working image of the native resolution is enlarged, so the plan is shown at the same size in both modes
+            self.scale_factor = self.scale_slider.value() / 200 * self.IMAGE_UPSCALE_RATE / self.working_scale
             self.image_label.setScaledContents(True)
 
             # Store the current scroll bar values
@@ -1872,7 +3295,8 @@ class Ui_MainWindow(object):
                         self.region_of_interest.center = (self.start_x, self.start_y)
                     elif self.delete_window_radio_button.isChecked():
                         selected_window_region_in_found is not None\
-                                        and self.found_windows.remove(selected_window_region_in_found)
+                                        and self.reject_found_variation(self.found_windows,
+                                                                        selected_window_region_in_found)
                         selected_window_region_in_confirmed is not None\
                                         and self.confirmed_windows.remove(selected_window_region_in_confirmed)
 
@@ -1892,7 +3316,7 @@ class Ui_MainWindow(object):
                         self.region_of_interest.center = (self.start_x, self.start_y)
                     elif self.delete_door_radio_button.isChecked():
                         selected_door_region_in_found is not None\
-                                        and self.found_doors.remove(selected_door_region_in_found)
+                                        and self.reject_found_variation(self.found_doors, selected_door_region_in_found)
                         selected_door_region_in_confirmed is not None\
                                         and self.confirmed_doors.remove(selected_door_region_in_confirmed)
 
@@ -1911,7 +3335,7 @@ class Ui_MainWindow(object):
                         self.region_of_interest.center = (self.start_x, self.start_y)
                     elif self.delete_furniture_radio_button.isChecked():
                         if selected_furniture_region_in_found is not None:
-                            self.found_furniture.remove(selected_furniture_region_in_found)
+                            self.reject_found_variation(self.found_furniture, selected_furniture_region_in_found)
                         if selected_furniture_region_in_confirmed is not None:
                             self.confirmed_furniture.remove(selected_furniture_region_in_confirmed)
 
@@ -2004,56 +3428,93 @@ class Ui_MainWindow(object):
     def corners_filters(self):
         self.corners_found = False
         self.show_filters_check_box.setChecked(True)
-        kernel_erode_1 = cv2.getStructuringElement(cv2.MORPH_RECT, (self.erode_1_spin_box.value(), self.erode_1_spin_box.value()))
-        kernel_dilate_1 = cv2.getStructuringElement(cv2.MORPH_RECT, (self.dilate_1_spin_box.value(), self.dilate_1_spin_box.value()))
-        kernel_erode_2 = cv2.getStructuringElement(cv2.MORPH_RECT, (self.erode_2_spin_box.value(), self.erode_2_spin_box.value()))
-        kernel_dilate_2 = cv2.getStructuringElement(cv2.MORPH_RECT, (self.dilate_2_spin_box.value(), self.dilate_2_spin_box.value()))
 
         if self.image is not None:
-            filtered_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-            _, filtered_image = cv2.threshold(filtered_image, self.threshold_maxval.value(), 255, cv2.THRESH_BINARY)
-
-            if self.erode_1_check_box.isChecked():
-                filtered_image = cv2.dilate(filtered_image, kernel_erode_1, iterations=1)
-            if self.dilate_1_check_box.isChecked():
-                filtered_image = cv2.erode(filtered_image, kernel_dilate_1, iterations=1)
-            if self.erode_2_check_box.isChecked():
-                filtered_image = cv2.dilate(filtered_image, kernel_erode_2, iterations=1)
-            if self.dilate_2_check_box.isChecked():
-                filtered_image = cv2.erode(filtered_image, kernel_dilate_2, iterations=1)
-
-            self.filtered_image = filtered_image
+            # Previews of the older parameters are not shown after this result
+            self.filter_generation += 1
+            self.filter_preview_pending = False
+            # Stages before the changed parameter are taken from the previous run
+            self.filtered_image = self.filter_pipeline.apply(self.image, self.get_filter_stages(self.working_scale))
+            self.filtered_preview_image = None
             self.set_image()
 
+    def schedule_filter_preview(self):
+        # Every change restarts the timer, so dragging a slider recomputes the filters only when it stops for a moment
+        self.corners_found = False
+        self.show_filters_check_box.setChecked(True)
+        if self.image is not None:
+            self.filter_generation += 1
+            self.filter_preview_pending = True
+            self.filter_preview_timer.start(self.FILTER_PREVIEW_DELAY)
+
+    def start_filter_preview(self):
+        # Running preview is not interrupted, the latest parameters are computed after it
+        if self.filter_preview_thread is not None and self.filter_preview_thread.isRunning():
+            return
+        jobs = []
+        if self.FILTER_PREVIEW_LOW_RESOLUTION and self.initial_image is not None and self.working_scale > 1:
+            # Preview of the imported plan is enlarged back to the working image size
+            jobs.append((self.preview_filter_pipeline, self.initial_image, self.get_filter_stages(1),
+                         (self.image.shape[1], self.image.shape[0])))
+        jobs.append((self.filter_pipeline, self.image, self.get_filter_stages(self.working_scale), None))
+        self.filter_preview_thread = FilterPreviewThread(self.filter_generation, jobs, lambda: self.filter_generation)
+        self.filter_preview_thread.preview_ready.connect(self.show_filter_preview)
+        self.filter_preview_thread.finished.connect(self.finish_filter_preview)
+        self.filter_preview_thread.start()
+
+    def show_filter_preview(self, generation, filtered_image, is_final):
+        # Results of the changed parameters are dropped
+        if generation != self.filter_generation:
+            return
+        if is_final:
+            self.filtered_image = filtered_image
+            self.filtered_preview_image = None
+            self.filter_preview_pending = False
+        else:
+            self.filtered_preview_image = filtered_image
+        self.set_image()
 
-    # Finding corners with cornerHarris
-    def find_corners(self):
+    def finish_filter_preview(self):
+        if self.filter_preview_pending and not self.filter_preview_timer.isActive():
+            self.start_filter_preview()
 
-        # Apply cornerHarris algorithm
-        dst = cv2.cornerHarris(self.filtered_image, blockSize=2 * self.IMAGE_UPSCALE_RATE,
-                               ksize=3 * self.IMAGE_UPSCALE_RATE, k=0.04)
+    def get_filter_stages(self, image_scale):
+        # Kernel sizes are set for the plan enlarged by IMAGE_UPSCALE_RATE, smaller images get smaller kernels
+        def get_kernel_size(spin_box):
+            return max(spin_box.value() * image_scale // self.IMAGE_UPSCALE_RATE, 1)
 
-        # Define a threshold to identify strong corners
-        threshold = self.quality_level_spin_box.value() * dst.max()
+        # Lines are black on the white background, so the dilation of the image erodes the lines and vice versa
+        stages = [('gray', None), ('threshold', self.threshold_maxval.value())]
+        if self.erode_1_check_box.isChecked():
+            stages.append(('dilate', get_kernel_size(self.erode_1_spin_box)))
+        if self.dilate_1_check_box.isChecked():
+            stages.append(('erode', get_kernel_size(self.dilate_1_spin_box)))
+        if self.erode_2_check_box.isChecked():
+            stages.append(('dilate', get_kernel_size(self.erode_2_spin_box)))
+        if self.dilate_2_check_box.isChecked():
+            stages.append(('erode', get_kernel_size(self.dilate_2_spin_box)))
+        return stages
 
-        # Find corner coordinates
-        corners = np.argwhere(dst > threshold)
-        corners = corners.tolist()
 
-        if corners:
-            for i in range(len(corners)):
-                corners[i] = [corners[i][1], corners[i][0]]
+    # Finding corners with cornerHarris
+    def find_corners(self):
+        # Corners are found on the filters of the latest parameters, even if their preview is not ready yet
+        if self.filter_preview_pending:
+            self.corners_filters()
 
-            # Refine corner locations using cornerSubPix
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
-            corners = np.float32(corners)
-            cv2.cornerSubPix(self.filtered_image, corners, (5, 5), (-1, -1), criteria)
-            corners = np.intp(corners)
+        # Find corner coordinates, one for every area above the quality level
+        corners = get_corner_centroids(self.get_corners_response(), self.quality_level_spin_box.value())
 
+        if len(corners) > 0 or self.corners_found:
             self.image_with_corners = self.image.copy()
             self.filtered_image_with_corners = cv2.cvtColor(self.filtered_image, cv2.COLOR_GRAY2BGR)
             self.corners_found = True
-            self.corners = corners.tolist()
+            self.corners = []
+        if len(corners) > 0:
+            # Refine corner locations using cornerSubPix
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+            cv2.cornerSubPix(self.filtered_image, corners, (5, 5), (-1, -1), criteria)
+            self.corners = np.intp(corners).tolist()
             self.draw_corner_marks(self.corners, self.RED)
 
         if self.confirmed_corners is not None:
@@ -2061,6 +3522,19 @@ class Ui_MainWindow(object):
 
         self.set_image()
 
+    def get_corners_response(self):
+        # Harris response is kept until the filtered image changes, the quality level only thresholds it
+        if self.corners_response_image is not self.filtered_image:
+            self.corners_response = cv2.cornerHarris(self.filtered_image, blockSize=2 * self.working_scale,
+                                                     ksize=3 * self.working_scale, k=0.04)
+            self.corners_response_image = self.filtered_image
+        return self.corners_response
+
+    def update_corners_quality(self):
+        # Shown corners follow the quality level at once
+        if self.corners_found and self.filtered_image is not None:
+            self.find_corners()
+
     def find_outside_walls(self):
         outside_corners = cv2.convexHull(np.array(self.adjust_coordinates(self.confirmed_corners), dtype=np.float32))
         outside_corners_new = []
@@ -2083,38 +3557,124 @@ class Ui_MainWindow(object):
         return outside_walls
 
     def find_furniture(self, furniture_name):
-        found_furniture = self.prepare_template_and_find_variations(furniture_name)
-        self.found_windows = None
+        # Search runs in the background, found variations are shown while it goes on
+        if self.search_thread is not None and self.search_thread.isRunning():
+            return
+        self.prepare_template_and_find_variations(furniture_name)
+
+    def prepare_found_variations(self, found_variations, furniture_name):
+        # Variations of a running search are sent several times, so they are copied before scaling
+        prepared_variations = []
+        for found_variation in found_variations:
+            furniture_variation = dict(found_variation)
+            furniture_variation['center'] = tuple(value * self.working_scale for value in furniture_variation['center'])
+            furniture_variation['size'] = tuple(value * self.working_scale for value in furniture_variation['size'])
+            if furniture_name == 'window':
+                furniture_variation['casements'] = self.windows_casements_spin_box.value()
+            if furniture_name == 'door':
+                furniture_variation['door_type'] = self.get_door_type()
+            prepared_variations.append(furniture_variation)
+        return prepared_variations
+
+    def set_found_variations(self, furniture_name, found_variations):
+        # All candidates of the search are kept, so another threshold or amount to find does not need a new search
+        self.found_candidates[furniture_name] = list(found_variations)
+        found_furniture = self.show_found_candidates(furniture_name)
         if len(found_furniture) > 0:
             self.draw_region_of_interest = False
-            for furniture_variation in found_furniture:
-                furniture_variation['center'] = tuple(value * self.IMAGE_UPSCALE_RATE for value in furniture_variation['center'])
-                furniture_variation['size'] = tuple(value * self.IMAGE_UPSCALE_RATE for value in furniture_variation['size'])
-                if furniture_name == 'window':
-                    furniture_variation['casements'] = self.windows_casements_spin_box.value()
-                if furniture_name == 'door':
-                    furniture_variation['door_type'] = self.get_door_type()
-            if furniture_name == 'window':
-                if self.found_windows is not None:
-                    self.found_windows.append(found_furniture)
-                else:
-                    self.found_windows = found_furniture
-            elif furniture_name == 'door':
-                if self.found_doors is not None:
-                    self.found_doors.append(found_furniture)
-                else:
-                    self.found_doors = found_furniture
-            else:
-                if self.found_furniture is not None:
-                    self.found_furniture.append(found_furniture)
-                else:
-                    self.found_furniture = found_furniture
             self.rectangle_drawn = False
             self.draw_all_rois()
 
+    def show_found_candidates(self, furniture_name):
+        # Best candidates above the threshold, not more than the amount of elements to find
+        threshold = self.search_threshold_spin_box.value()
+        candidates = [candidate for candidate in self.found_candidates.get(furniture_name, [])
+                      if candidate['score'] >= threshold
+                      and self.get_candidate_key(candidate) not in self.rejected_candidates]
+        candidates.sort(key=lambda candidate: -candidate['score'])
+        found_furniture = self.prepare_found_variations(candidates[:self.get_elements_to_find(furniture_name)],
+                                                        furniture_name)
+        if furniture_name == 'window':
+            self.found_windows = found_furniture or None
+        elif furniture_name == 'door':
+            self.found_doors = found_furniture or None
+        else:
+            # Furniture of other types found before is kept
+            other_furniture = [furniture_variation for furniture_variation in self.found_furniture or []
+                               if furniture_variation['furniture_name'] != furniture_name]
+            self.found_furniture = other_furniture + found_furniture or None
+        return found_furniture
+
+    def get_candidate_key(self, variation, scale=1):
+        # Found elements are scaled to the working image, candidates are kept in the plan coordinates
+        return (variation['furniture_name'], tuple(round(value / scale, 1) for value in variation['center']),
+                round(float(variation['rotation_angle']), 1))
+
+    def reject_found_variation(self, found_variations, found_variation):
+        # Deleted element is not shown again by the next filtering or by the running search
+        found_variations.remove(found_variation)
+        self.rejected_candidates.add(self.get_candidate_key(found_variation, self.working_scale))
+
+    def filter_found_variations(self):
+        # Candidates of the last searches are filtered again without matching
+        if not self.found_candidates:
+            return
+        for furniture_name in self.found_candidates:
+            self.show_found_candidates(furniture_name)
+        self.draw_all_rois()
+
+    def start_search(self, furniture_names, search_function, *args, **kwargs):
+        self.searched_furniture_names = list(furniture_names)
+        for furniture_name in self.searched_furniture_names:
+            self.set_found_variations(furniture_name, [])
+        self.search_thread = TemplateSearchThread(search_function, *args, **kwargs)
+        self.search_thread.progress_changed.connect(self.show_search_progress)
+        self.search_thread.search_finished.connect(self.finish_search)
+        self.search_progress_bar.setValue(0)
+        self.cancel_search_push_button.setEnabled(True)
+        self.search_thread.start()
+
+    def show_search_progress(self, steps_done, steps_amount, found_variations):
+        self.search_progress_bar.setValue(int(100 * steps_done / steps_amount) if steps_amount else 100)
+        if found_variations:
+            self.set_found_variations(found_variations[0]['furniture_name'], found_variations)
+
+    def finish_search(self, found_variations):
+        if isinstance(found_variations, dict):
+            for furniture_name, variations in found_variations.items():
+                self.set_found_variations(furniture_name, variations)
+        elif found_variations is not None:
+            self.set_found_variations(self.searched_furniture_names[0], found_variations)
+        self.search_progress_bar.setValue(100)
+        self.cancel_search_push_button.setEnabled(False)
+
+    def cancel_search(self):
+        # Variations found before the cancellation are kept
+        if self.search_thread is not None:
+            self.search_thread.cancel()
+
+    def find_all_elements(self):
+        # Every element type which was already searched by its region of interest is searched again in one pass
+        if self.initial_image is None or not self.element_templates:
+            return
+        if self.search_thread is not None and self.search_thread.isRunning():
+            return
+        elements_amounts = {furniture_name: self.get_elements_to_find(furniture_name)
+                            for furniture_name in self.element_templates}
+        search_areas = {furniture_name: self.get_search_area(furniture_name, template)
+                        for furniture_name, template in self.element_templates.items()}
+        self.start_search(self.element_templates, find_all_template_variations, self.initial_image,
+                          dict(self.element_templates), elements_amounts, threshold=self.SEARCH_CANDIDATES_THRESHOLD,
+                          pyramid_levels=self.TEMPLATE_PYRAMID_LEVELS, workers=self.TEMPLATE_MATCHING_WORKERS,
+                          engine=self.get_matching_engine(), get_orientations=self.get_plan_orientations_getter(),
+                          search_areas=search_areas, scales=self.get_template_scales(),
+                          ink_density_prefilter=self.ink_density_prefilter_check_box.isChecked(),
+                          cache=detection_cache)
+
     def confirm_windows(self):
         self.show_confired_windows_ckeck_box.setChecked(True)
         self.found_windows = None
+        self.found_candidates.pop('window', None)
         if self.draw_region_of_interest:
             self.draw_region_of_interest = False
             variation = {
@@ -2135,6 +3695,7 @@ class Ui_MainWindow(object):
     def confirm_doors(self):
         self.show_confired_doors_ckeck_box.setChecked(True)
         self.found_doors = None
+        self.found_candidates.pop('door', None)
         if self.draw_region_of_interest:
             self.draw_region_of_interest = False
             variation = {
@@ -2155,6 +3716,9 @@ class Ui_MainWindow(object):
     def confirm_furniture(self):
         furniture_name = self.furniture_list[self.furniture_type_combo_box.currentIndex()]['Тип мебели']
         self.found_furniture = None
+        self.found_candidates = {furniture_name: candidates
+                                 for furniture_name, candidates in self.found_candidates.items()
+                                 if furniture_name in ('window', 'door')}
         if self.draw_region_of_interest:
             self.draw_region_of_interest = False
             variation = {
@@ -2170,15 +3734,56 @@ class Ui_MainWindow(object):
         self.draw_all_rois()
 
     def prepare_template_and_find_variations(self, furniture_name):
-        size = tuple(value // self.IMAGE_UPSCALE_RATE for value in self.region_of_interest.size)
-        center = tuple(value // self.IMAGE_UPSCALE_RATE for value in self.region_of_interest.center)
-        transformation_matrix = cv2.getRotationMatrix2D(center, self.region_of_interest.angle, 1.0)
-        rotated_image = cv2.warpAffine(self.initial_image, transformation_matrix, (self.initial_image.shape[1], self.initial_image.shape[0]))
-        template = cv2.getRectSubPix(rotated_image, size, center)
-        found_variations = find_template_variations(self.initial_image, template, furniture_name, self.windows_to_find_spin_box.value(),
-                                                 threshold=0.9)
-        return found_variations
+        size = tuple(value // self.working_scale for value in self.region_of_interest.size)
+        center = tuple(value // self.working_scale for value in self.region_of_interest.center)
+        template = get_rotated_patch(self.initial_image, center, size, self.region_of_interest.angle)
+        # Template is kept for the search of all element types at once
+        self.element_templates[furniture_name] = template
+        search_area = self.get_search_area(furniture_name, template)
+        self.start_search([furniture_name], find_template_variations, self.initial_image, template, furniture_name,
+                          self.get_elements_to_find(furniture_name), threshold=self.SEARCH_CANDIDATES_THRESHOLD,
+                          pyramid_levels=self.TEMPLATE_PYRAMID_LEVELS, workers=self.TEMPLATE_MATCHING_WORKERS,
+                          engine=self.get_matching_engine(), get_orientations=self.get_plan_orientations_getter(),
+                          search_area=search_area, scales=self.get_template_scales(),
+                          ink_density_prefilter=self.ink_density_prefilter_check_box.isChecked(),
+                          cache=detection_cache)
     
+    def get_search_area(self, furniture_name, template):
+        excluded_rectangles = self.get_excluded_rectangles()
+        # Windows and doors are searched only near the confirmed walls
+        if furniture_name in ('window', 'door') and self.confirmed_walls:
+            walls = [tuple(tuple(value / self.working_scale for value in corner) for corner in wall)
+                     for wall in self.confirmed_walls]
+            # Band has to fit the largest searched size of the template
+            template_shape = tuple(int(value * max(self.get_template_scales())) for value in template.shape[:2])
+            return get_wall_band_search_area(self.initial_image.shape, walls, template_shape, excluded_rectangles)
+        if excluded_rectangles:
+            return SearchArea(self.initial_image.shape, excluded_rectangles=excluded_rectangles)
+        return None
+
+    def get_excluded_rectangles(self):
+        # Confirmed elements of all types are skipped by the next searches
+        excluded_rectangles = []
+        confirmed_elements = (self.confirmed_windows or []) + (self.confirmed_doors or []) + \
+            (self.confirmed_furniture or [])
+        for variation in confirmed_elements:
+            excluded_rectangles.append((tuple(value / self.working_scale for value in variation['center']),
+                                        tuple(value / self.working_scale for value in variation['size']),
+                                        float(variation['rotation_angle'])))
+        return excluded_rectangles
+
+    def get_template_scales(self):
+        if self.template_scales_check_box.isChecked():
+            return self.TEMPLATE_SCALES
+        return (1.0,)
+
+    def get_elements_to_find(self, furniture_name):
+        if furniture_name == 'window':
+            return self.windows_to_find_spin_box.value()
+        if furniture_name == 'door':
+            return self.doors_to_find_spin_box.value()
+        return self.furniture_to_find_spin_box.value()
+
     def set_corners_found(self):
         self.corners_found = True
 
@@ -2224,33 +3829,40 @@ class Ui_MainWindow(object):
 
     def draw_corner_marks(self, corners, color):
         if len(corners) > 0:
+            outer_radius, inner_radius, thickness = (self.get_overlay_size(size) for size in (15, 4, 2))
             for corner in corners:
                 x, y = corner
                 if corner == self.first_selected_corner:
-                    cv2.circle(self.image_with_corners, (x, y), 15, self.RED, 2)
-                    cv2.circle(self.image_with_corners, (x, y), 4, self.RED, 2)
-                    cv2.circle(self.filtered_image_with_corners, (x, y), 15, self.RED, 2)
-                    cv2.circle(self.filtered_image_with_corners, (x, y), 4, self.RED, 2)
+                    cv2.circle(self.image_with_corners, (x, y), outer_radius, self.RED, thickness)
+                    cv2.circle(self.image_with_corners, (x, y), inner_radius, self.RED, thickness)
+                    cv2.circle(self.filtered_image_with_corners, (x, y), outer_radius, self.RED, thickness)
+                    cv2.circle(self.filtered_image_with_corners, (x, y), inner_radius, self.RED, thickness)
                 else:
-                    cv2.circle(self.image_with_corners, (x, y), 15, color, 2)
-                    cv2.circle(self.image_with_corners, (x, y), 4, color, 2)
-                    cv2.circle(self.filtered_image_with_corners, (x, y), 15, color, 2)
-                    cv2.circle(self.filtered_image_with_corners, (x, y), 4, color, 2)
+                    cv2.circle(self.image_with_corners, (x, y), outer_radius, color, thickness)
+                    cv2.circle(self.image_with_corners, (x, y), inner_radius, color, thickness)
+                    cv2.circle(self.filtered_image_with_corners, (x, y), outer_radius, color, thickness)
+                    cv2.circle(self.filtered_image_with_corners, (x, y), inner_radius, color, thickness)
         self.draw_walls()
 
         self.set_image()
 
+    def get_overlay_size(self, size):
+        # Sizes of marks are set for the plan enlarged by IMAGE_UPSCALE_RATE, the native resolution plan is shown
+        # enlarged, so its marks are drawn smaller
+        return max(round(size * self.working_scale / self.IMAGE_UPSCALE_RATE), 1)
+
     def draw_walls(self):
         if self.walls:
             for wall in self.walls:
                 start_pos, end_pos = wall
-                cv2.line(self.image_with_corners, start_pos, end_pos, self.RED, thickness=2)
-                cv2.line(self.filtered_image_with_corners, start_pos, end_pos, self.RED, thickness=2)
+                cv2.line(self.image_with_corners, start_pos, end_pos, self.RED, thickness=self.get_overlay_size(2))
+                cv2.line(self.filtered_image_with_corners, start_pos, end_pos, self.RED,
+                         thickness=self.get_overlay_size(2))
         if self.confirmed_walls:
             for wall in self.confirmed_walls:
                 start_pos, end_pos = wall
-                cv2.line(self.image_with_corners, start_pos, end_pos, self.GREEN, thickness=self.IMAGE_UPSCALE_RATE)
-                cv2.line(self.filtered_image_with_corners, start_pos, end_pos, self.GREEN, thickness=self.IMAGE_UPSCALE_RATE)
+                cv2.line(self.image_with_corners, start_pos, end_pos, self.GREEN, thickness=self.working_scale)
+                cv2.line(self.filtered_image_with_corners, start_pos, end_pos, self.GREEN, thickness=self.working_scale)
 
     def draw_rectangles(self, save=False):
         if self.image is not None:
@@ -2271,17 +3883,22 @@ class Ui_MainWindow(object):
             # Drawing rectangles
             if self.tabWidget.currentIndex() == 0:
                 if self.resizing_rectangle:
-                    cv2.rectangle(self.image_with_rectangle, self.rectangle[0], self.rectangle[1], self.RED, 1)
+                    cv2.rectangle(self.image_with_rectangle, self.rectangle[0], self.rectangle[1], self.RED,
+                                  self.get_overlay_size(1))
                 elif self.drawing:
-                    cv2.rectangle(self.image_with_rectangle, start_point, end_point, self.GREEN, 2)
+                    cv2.rectangle(self.image_with_rectangle, start_point, end_point, self.GREEN,
+                                  self.get_overlay_size(2))
                 elif self.rectangle:
-                    cv2.rectangle(self.image_with_rectangle, self.rectangle[0], self.rectangle[1], self.GREEN, 2)
+                    cv2.rectangle(self.image_with_rectangle, self.rectangle[0], self.rectangle[1], self.GREEN,
+                                  self.get_overlay_size(2))
 
             elif self.tabWidget.currentIndex() == 2:
                 if self.drawing:
-                    cv2.rectangle(self.image_with_interior_elements, start_point, end_point, self.RED, 2)
+                    cv2.rectangle(self.image_with_interior_elements, start_point, end_point, self.RED,
+                                  self.get_overlay_size(2))
                 elif self.draw_region_of_interest:
-                    self.region_of_interest.draw_rotated_rectangle(self.image_with_interior_elements, color=self.RED)
+                    self.region_of_interest.draw_rotated_rectangle(self.image_with_interior_elements, color=self.RED,
+                                                                   thickness=self.get_overlay_size(2))
 
             self.rectangle_drawn = True
             self.set_image()
@@ -2290,11 +3907,13 @@ class Ui_MainWindow(object):
         for roi in rois:
             center = roi['center']
             size = roi['size']
-            rotation_angle = int(roi['rotation_angle'])
+            # Refined angles have a fractional part, they are drawn and shown without truncation
+            rotation_angle = round(float(roi['rotation_angle']), 1)
             furniture_name = roi['furniture_name']
 
             current_rotated_rectangle = RotatedRectangle(center, size, rotation_angle)
-            current_rotated_rectangle.draw_rotated_rectangle(self.image_with_interior_elements, color=color)
+            current_rotated_rectangle.draw_rotated_rectangle(self.image_with_interior_elements, color=color,
+                                                             thickness=self.get_overlay_size(2))
 
             if size[0] > size[1] and 90 < rotation_angle < 180:
                 half_size = size[0] // 2
@@ -2306,13 +3925,13 @@ class Ui_MainWindow(object):
 
             cv2.putText(self.image_with_interior_elements, f"{rotation_angle} degrees", (center[0],
                         (center[1] - vertical_offset)),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.IMAGE_UPSCALE_RATE, color, self.IMAGE_UPSCALE_RATE)
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.working_scale, color, self.working_scale)
             cv2.putText(self.image_with_interior_elements, furniture_name, (center[0],
-                        (center[1] - vertical_offset - 40 * self.IMAGE_UPSCALE_RATE)),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.IMAGE_UPSCALE_RATE, color, self.IMAGE_UPSCALE_RATE)
+                        (center[1] - vertical_offset - 40 * self.working_scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.working_scale, color, self.working_scale)
             cv2.putText(self.image_with_interior_elements, f'Size: {size[0]} x {size[1]}', (center[0],
-                        (center[1] - vertical_offset - 20 * self.IMAGE_UPSCALE_RATE)),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.IMAGE_UPSCALE_RATE, color, self.IMAGE_UPSCALE_RATE)
+                        (center[1] - vertical_offset - 20 * self.working_scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * self.working_scale, color, self.working_scale)
 
     def draw_all_rois(self, mouse_move=True):
         self.image_with_interior_elements = self.image.copy()
@@ -2333,12 +3952,12 @@ class Ui_MainWindow(object):
         vertical_size = abs(self.rectangle[1][1] - self.rectangle[0][1]) * self.vertical_image_size_scale
         color = self.GREEN if self.real_sizes_confirmed else self.RED
         cv2.putText(self.image_with_rectangle, f'{int(horizontal_size)} mm x {int(vertical_size)} mm',
-                    (self.rectangle[0][0], self.rectangle[0][1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 1 / self.scale_factor,
-                    color, thickness=int(2 / self.scale_factor))
+                    (self.rectangle[0][0], self.rectangle[0][1] - self.get_overlay_size(10)), cv2.FONT_HERSHEY_SIMPLEX,
+                    1 / self.scale_factor, color, thickness=int(2 / self.scale_factor))
         self.set_image()
 
     def get_resizing_corner(self, rect, x, y):
-        tolerance = 20
+        tolerance = self.get_overlay_size(20)
 
         top_left = (rect[0])
         top_right = (rect[1][0], rect[0][1])
@@ -2400,19 +4019,19 @@ class Ui_MainWindow(object):
             self.region_of_interest.center = [x + delta_x, y + delta_y]
 
     def increase_roi_width(self):
-        self.region_of_interest.size = (self.region_of_interest.size[0] + self.IMAGE_UPSCALE_RATE, self.region_of_interest.size[1])
+        self.region_of_interest.size = (self.region_of_interest.size[0] + self.working_scale, self.region_of_interest.size[1])
         self.resize_roi()
 
     def decrease_roi_width(self):
-        self.region_of_interest.size = (self.region_of_interest.size[0] - self.IMAGE_UPSCALE_RATE, self.region_of_interest.size[1])
+        self.region_of_interest.size = (self.region_of_interest.size[0] - self.working_scale, self.region_of_interest.size[1])
         self.resize_roi()
 
     def increase_roi_height(self):
-        self.region_of_interest.size = (self.region_of_interest.size[0], self.region_of_interest.size[1] + self.IMAGE_UPSCALE_RATE)
+        self.region_of_interest.size = (self.region_of_interest.size[0], self.region_of_interest.size[1] + self.working_scale)
         self.resize_roi()
 
     def decrease_roi_height(self):
-        self.region_of_interest.size = (self.region_of_interest.size[0], self.region_of_interest.size[1] - self.IMAGE_UPSCALE_RATE)
+        self.region_of_interest.size = (self.region_of_interest.size[0], self.region_of_interest.size[1] - self.working_scale)
         self.resize_roi()
 
     def resize_roi(self):
@@ -2434,12 +4053,12 @@ class Ui_MainWindow(object):
     def find_selected_corner(self, x, y):
         for corner in self.corners:
             corner_x, corner_y = corner
-            if is_coordinate_inside_circle(x, y, corner_x, corner_y, self.SELECTING_TOLERANCE * self.IMAGE_UPSCALE_RATE):
+            if is_coordinate_inside_circle(x, y, corner_x, corner_y, self.SELECTING_TOLERANCE * self.working_scale):
                 return corner
 
         for corner in self.confirmed_corners:
             corner_x, corner_y = corner
-            if is_coordinate_inside_circle(x, y, corner_x, corner_y, self.SELECTING_TOLERANCE * self.IMAGE_UPSCALE_RATE):
+            if is_coordinate_inside_circle(x, y, corner_x, corner_y, self.SELECTING_TOLERANCE * self.working_scale):
                 return corner
 
     def adjust_walls_data(self):
@@ -2478,6 +4097,38 @@ class Ui_MainWindow(object):
     def adjust_furniture_size(self, size):
         return (size[0] * self.horizontal_image_size_scale / 1000, size[1] * self.vertical_image_size_scale / 1000)
 
+    def get_plan_orientations_getter(self):
+        # Free-form plans are searched at all angles
+        if not self.dominant_orientations_check_box.isChecked():
+            return None
+        if self.confirmed_walls:
+            walls = list(self.confirmed_walls)
+            return lambda: get_dominant_orientations(walls=walls)
+        image = self.filtered_image if self.filtered_image is not None else self.initial_image
+        initial_size = (self.initial_image.shape[1], self.initial_image.shape[0])
+
+        def get_orientations():
+            # Orientations are kept until the filters are changed
+            cached_image, orientations = self.plan_orientations
+            if cached_image is not image:
+                # Filtered image is enlarged to the working scale, its orientations are the same in the imported size
+                native_image = image
+                if (image.shape[1], image.shape[0]) != initial_size:
+                    native_image = cv2.resize(image, initial_size, interpolation=cv2.INTER_AREA)
+                orientations = get_dominant_orientations(native_image)
+                self.plan_orientations = (image, orientations)
+            return orientations
+        return get_orientations
+
+    def get_matching_engine(self):
+        if self.matching_engine_combo_box.currentIndex() == 1:
+            matching_engine = 'fft'
+        elif self.matching_engine_combo_box.currentIndex() == 2:
+            matching_engine = 'chamfer'
+        else:
+            matching_engine = 'opencv'
+        return matching_engine
+
     def get_door_type(self):
         if self.door_type_combo_box.currentIndex() == 0:
             door_type = 'entrance_door'
@@ -2542,9 +4193,67 @@ class RotatedRectangle:
             return False
 
 
+class TemplateSearchThread(QtCore.QThread):
+    # Template search outside of the GUI thread, variations found so far are sent with the progress
+    progress_changed = QtCore.pyqtSignal(int, int, object)
+    search_finished = QtCore.pyqtSignal(object)
+
+    def __init__(self, search_function, *args, get_orientations=None, **kwargs):
+        super().__init__()
+        self.search_function = search_function
+        self.args = args
+        self.kwargs = kwargs
+        # Orientations of the whole plan take a while, so they are computed here instead of the GUI thread
+        self.get_orientations = get_orientations
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        try:
+            if self.get_orientations is not None:
+                self.kwargs['orientations'] = self.get_orientations()
+            found_variations = self.search_function(*self.args, cancel_event=self.cancel_event,
+                                                    progress_callback=self.report_progress, **self.kwargs)
+        except Exception as error:
+            print(f'Template search failed: {error}')
+            found_variations = None
+        self.search_finished.emit(found_variations)
+
+    def report_progress(self, steps_done, steps_amount, found_variations):
+        self.progress_changed.emit(steps_done, steps_amount, found_variations)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+class FilterPreviewThread(QtCore.QThread):
+    # Filter chain outside of the GUI thread, jobs are (pipeline, image, stages, preview size), the last one is final
+    preview_ready = QtCore.pyqtSignal(int, object, bool)
+
+    def __init__(self, generation, jobs, get_generation):
+        super().__init__()
+        self.generation = generation
+        self.jobs = jobs
+        self.get_generation = get_generation
+
+    def run(self):
+        for filter_pipeline, image, stages, preview_size in self.jobs:
+            # Parameters were changed again, the next preview computes them
+            if self.get_generation() != self.generation:
+                return
+            try:
+                filtered_image = filter_pipeline.apply(image, stages)
+                if preview_size is not None:
+                    filtered_image = cv2.resize(filtered_image, preview_size, interpolation=cv2.INTER_NEAREST)
+            except Exception as error:
+                print(f'Filter preview failed: {error}')
+                return
+            self.preview_ready.emit(self.generation, filtered_image, preview_size is None)
+
+
 if __name__ == "__main__":
     import sys
     app = QtWidgets.QApplication(sys.argv)
+    app.aboutToQuit.connect(shutdown_matching_executor)
     MainWindow = QtWidgets.QMainWindow()
     ui = Ui_MainWindow()
     MainWindow.show()